@@ -0,0 +1,294 @@
+"""
+Historical backfill of arXiv papers through the OAI-PMH interface.
+Pages through ListRecords for a date range, follows resumption tokens and appends the papers of the
+configured categories to a jsonl file. A checkpoint is written after every page, so an interrupted
+backfill picks up at the page where it stopped.
+The date range refers to the day a paper was first submitted. OAI-PMH selects records by the date
+their metadata last changed instead, so the request asks for everything changed since the start of
+the range, which includes papers revised after its end, and records created outside the range are
+dropped.
+
+usage: python arxiv_backfill.py --months 3
+       python arxiv_backfill.py --from 2024-01-01 --until 2024-03-31
+"""
+
+import argparse
+import configparser
+import dataclasses
+import json
+import os
+import time
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
+from xml.etree import ElementTree
+
+import requests
+
+from arxiv_scraper import Paper
+from metrics import METRICS
+from storage import atomic_write
+
+OAI_NS = "{http://www.openarchives.org/OAI/2.0/}"
+ARXIV_OAI_NS = "{http://arxiv.org/OAI/arXiv/}"
+# archives with a top level OAI set, every other archive is a set below physics
+TOP_LEVEL_SETS = set(["cs", "econ", "eess", "math", "q-bio", "q-fin", "stat"])
+
+
+def oai_set_for_area(area: str) -> str:
+    # cs.CL -> cs, stat.ML -> stat, hep-th -> physics:hep-th, astro-ph.GA -> physics:astro-ph,
+    # physics.optics -> physics:physics
+    archive = area.split(".")[0]
+    if archive in TOP_LEVEL_SETS:
+        return archive
+    return "physics:" + archive
+
+
+def clean_text(text: Optional[str]) -> str:
+    # OAI metadata is hard wrapped, collapse all whitespace runs into single spaces
+    return " ".join((text or "").split())
+
+
+def parse_list_records(
+    body: bytes,
+    areas: List[str],
+    force_primary: bool,
+    from_date: date = None,
+    until_date: date = None,
+) -> Tuple[List[Paper], Optional[str]]:
+    # returns the papers of one ListRecords page and the resumption token of the next page.
+    # papers created before from_date or after until_date are skipped
+    root = ElementTree.fromstring(body)
+    error = root.find(OAI_NS + "error")
+    if error is not None:
+        if error.get("code") == "noRecordsMatch":
+            return [], None
+        raise ValueError(
+            "OAI-PMH error " + str(error.get("code")) + ": " + clean_text(error.text)
+        )
+    paper_list = []
+    for record in root.iter(OAI_NS + "record"):
+        header = record.find(OAI_NS + "header")
+        if header is not None and header.get("status") == "deleted":
+            continue
+        metadata = record.find(OAI_NS + "metadata/" + ARXIV_OAI_NS + "arXiv")
+        if metadata is None:
+            continue
+        created = clean_text(metadata.findtext(ARXIV_OAI_NS + "created"))
+        if from_date is not None and created and created < from_date.isoformat():
+            continue
+        if until_date is not None and created and created > until_date.isoformat():
+            continue
+        categories = clean_text(metadata.findtext(ARXIV_OAI_NS + "categories")).split()
+        if force_primary:
+            if not categories or categories[0] not in areas:
+                continue
+        elif not any(category in areas for category in categories):
+            continue
+        authors = []
+        for author in metadata.iter(ARXIV_OAI_NS + "author"):
+            name = " ".join(
+                clean_text(author.findtext(ARXIV_OAI_NS + field))
+                for field in ["forenames", "keyname", "suffix"]
+            )
+            authors.append(clean_text(name))
+        paper_list.append(
+            Paper(
+                authors=authors,
+                title=clean_text(metadata.findtext(ARXIV_OAI_NS + "title")),
+                abstract=clean_text(metadata.findtext(ARXIV_OAI_NS + "abstract")),
+                arxiv_id=clean_text(metadata.findtext(ARXIV_OAI_NS + "id")),
+            )
+        )
+    token = root.find(OAI_NS + "ListRecords/" + OAI_NS + "resumptionToken")
+    if token is None or not clean_text(token.text):
+        return paper_list, None
+    return paper_list, clean_text(token.text)
+
+
+def fetch_page(
+    session, base_url: str, params: dict, timeout: float, max_retries: int = 5
+) -> bytes:
+    # arxiv answers 503 with a Retry-After header when it wants us to slow down
+    for _ in range(max_retries):
+        with METRICS.call("arxiv"):
+            response = session.get(base_url, params=params, timeout=timeout)
+        with response:
+            if response.status_code == 503:
+                METRICS.count("retries", "arxiv")
+                retry_after = response.headers.get("Retry-After", "10")
+                delay = float(retry_after) if retry_after.isdigit() else 10.0
+                print("OAI-PMH server busy, retrying in " + str(delay) + "s")
+                time.sleep(delay)
+                continue
+            response.raise_for_status()
+            return response.content
+    raise requests.exceptions.RetryError(
+        "OAI-PMH server still busy after " + str(max_retries) + " tries"
+    )
+
+
+def load_checkpoint(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(path: str, checkpoint: dict) -> None:
+    with atomic_write(path) as f:
+        json.dump(checkpoint, f, indent=4)
+
+
+def backfill_set(
+    oai_set: str,
+    areas: List[str],
+    from_date: date,
+    until_date: date,
+    config: configparser.ConfigParser,
+    session=None,
+) -> str:
+    # backfills one OAI set and returns the path of the jsonl file holding its papers
+    base_url = config["BACKFILL"].get(
+        "oai_base_url", fallback="http://export.arxiv.org/oai2"
+    )
+    request_interval = config["BACKFILL"].getfloat("request_interval", fallback=3.0)
+    timeout = config["BACKFILL"].getfloat("request_timeout", fallback=60.0)
+    backfill_path = config["BACKFILL"].get("backfill_path", fallback="out/backfill/")
+    force_primary = config["FILTERING"].getboolean("force_primary")
+    os.makedirs(backfill_path, exist_ok=True)
+    name = (
+        oai_set.replace(":", "_")
+        + "_"
+        + from_date.isoformat()
+        + "_"
+        + until_date.isoformat()
+    )
+    output_path = os.path.join(backfill_path, name + ".jsonl")
+    checkpoint_path = os.path.join(backfill_path, name + ".checkpoint.json")
+
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is not None and checkpoint["done"]:
+        print("Backfill of " + name + " already complete")
+        return output_path
+    if checkpoint is None:
+        checkpoint = {
+            "resumption_token": None,
+            "pages": 0,
+            "papers": 0,
+            "offset": 0,
+            "done": False,
+        }
+    else:
+        print(
+            "Resuming backfill of " + name + " after page " + str(checkpoint["pages"])
+        )
+
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+    try:
+        with open(output_path, "a+") as outfile:
+            # drop anything written after the last checkpoint, that page is fetched again
+            outfile.truncate(checkpoint["offset"])
+            outfile.seek(checkpoint["offset"])
+            last_request = 0.0
+            while True:
+                if checkpoint["resumption_token"] is None:
+                    params = {
+                        "verb": "ListRecords",
+                        "metadataPrefix": "arXiv",
+                        "set": oai_set,
+                        # no until: papers of the range revised later are listed
+                        # by the day of their last change
+                        "from": from_date.isoformat(),
+                    }
+                else:
+                    params = {
+                        "verb": "ListRecords",
+                        "resumptionToken": checkpoint["resumption_token"],
+                    }
+                # respect the configured request rate
+                wait = last_request + request_interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                last_request = time.monotonic()
+                body = fetch_page(session, base_url, params, timeout)
+                paper_list, token = parse_list_records(
+                    body, areas, force_primary, from_date, until_date
+                )
+                for paper in paper_list:
+                    outfile.write(json.dumps(dataclasses.asdict(paper)) + "\n")
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                checkpoint["resumption_token"] = token
+                checkpoint["pages"] += 1
+                checkpoint["papers"] += len(paper_list)
+                checkpoint["offset"] = outfile.tell()
+                checkpoint["done"] = token is None
+                save_checkpoint(checkpoint_path, checkpoint)
+                if config["OUTPUT"].getboolean("debug_messages"):
+                    print(
+                        "Backfill "
+                        + name
+                        + ": page "
+                        + str(checkpoint["pages"])
+                        + ", "
+                        + str(checkpoint["papers"])
+                        + " papers"
+                    )
+                if token is None:
+                    return output_path
+    finally:
+        if own_session:
+            session.close()
+
+
+def backfill(areas: List[str], from_date: date, until_date: date, config) -> List[str]:
+    # one OAI set can hold several of the configured categories, backfill each set once
+    sets = {}
+    for area in areas:
+        sets.setdefault(oai_set_for_area(area), []).append(area)
+    with requests.Session() as session:
+        return [
+            backfill_set(oai_set, set_areas, from_date, until_date, config, session)
+            for oai_set, set_areas in sets.items()
+        ]
+
+
+def load_backfilled_papers(path: str) -> List[Paper]:
+    with open(path, "r") as f:
+        return [Paper(**json.loads(line)) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read("configs/config.ini")
+    parser = argparse.ArgumentParser(
+        description="Backfill arXiv papers over a date range"
+    )
+    parser.add_argument(
+        "--from", dest="from_date", help="first submission day, YYYY-MM-DD"
+    )
+    parser.add_argument(
+        "--until", dest="until_date", help="last submission day, YYYY-MM-DD"
+    )
+    parser.add_argument(
+        "--months", type=int, default=1, help="backfill this many months up to today"
+    )
+    parser.add_argument(
+        "--categories",
+        default=config["FILTERING"]["arxiv_category"],
+        help="comma separated arxiv categories, defaults to arxiv_category in config.ini",
+    )
+    args = parser.parse_args()
+    until_date = (
+        date.fromisoformat(args.until_date) if args.until_date else date.today()
+    )
+    if args.from_date:
+        from_date = date.fromisoformat(args.from_date)
+    else:
+        from_date = until_date - timedelta(days=30 * args.months)
+    areas = [area.strip() for area in args.categories.split(",")]
+    for path in backfill(areas, from_date, until_date, config):
+        print("Backfilled papers written to " + path)
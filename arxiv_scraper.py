@@ -1,14 +1,22 @@
 import configparser
 import dataclasses
+import io
+import itertools
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from html import unescape
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
 import re
 import arxiv
 
-import feedparser
+import requests
 from dataclasses import dataclass
+from feed_state import FeedStateStore
+from metrics import METRICS
+from requests.adapters import HTTPAdapter
 
 
 class EnhancedJSONEncoder(json.JSONEncoder):
@@ -31,115 +39,277 @@ class Paper:
         return hash(self.arxiv_id)
 
 
+# compiled once for all feeds instead of on every entry
+HTML_TAG_RE = re.compile("<[^<]+?>")
+TITLE_SUFFIX_RE = re.compile(r"\(arXiv:[0-9]+\.[0-9]+v[0-9]+ \[.*\]\)$")
+ARXIV_NS = "{http://arxiv.org/schemas/atom}"
+DC_NS = "{http://purl.org/dc/elements/1.1/}"
+
+
+def arxiv_id_key(arxiv_id: str) -> Tuple[int, int]:
+    # numeric sort key for new-style ids like 2401.01234v2: (yymm, number), version ignored.
+    # computed once per id so comparisons are plain tuple compares.
+    yymm, number = arxiv_id.split("v")[0].split(".")
+    return int(yymm), int(number)
+
+
 def is_earlier(ts1, ts2):
     # compares two arxiv ids, returns true if ts1 is older than ts2
-    return int(ts1.replace(".", "")) < int(ts2.replace(".", ""))
+    return arxiv_id_key(ts1) < arxiv_id_key(ts2)
 
 
-def get_papers_from_arxiv_api(area: str, timestamp, last_id) -> List[Paper]:
+def iter_papers_from_arxiv_api(
+    area: str,
+    timestamp,
+    last_id,
+    force_primary: bool = False,
+    page_size: int = 100,
+    max_results: int = 1000,
+) -> Iterator[Paper]:
     # look for papers that are newer than the newest papers in RSS.
-    # we do this by looking at last_id and grabbing everything newer.
+    # results come newest first and are fetched one page at a time, so we stop at the first id
+    # that is not newer than last_id instead of downloading the whole submission window.
     end_date = timestamp
     start_date = timestamp - timedelta(days=4)
     search = arxiv.Search(
-        query="("
+        query="cat:"
         + area
-        + ") AND submittedDate:["
+        + " AND submittedDate:["
         + start_date.strftime("%Y%m%d")
         + "* TO "
         + end_date.strftime("%Y%m%d")
         + "*]",
-        max_results=None,
+        max_results=max_results,
         sort_by=arxiv.SortCriterion.SubmittedDate,
+        sort_order=arxiv.SortOrder.Descending,
     )
-    results = list(arxiv.Client().results(search))
-    api_papers = []
-    for result in results:
-        new_id = result.get_short_id()[:10]
-        if is_earlier(last_id, new_id):
-            authors = [author.name for author in result.authors]
-            summary = result.summary
-            summary = unescape(re.sub("\n", " ", summary))
-            paper = Paper(
-                authors=authors,
-                title=result.title,
-                abstract=summary,
-                arxiv_id=result.get_short_id()[:10],
-            )
-            api_papers.append(paper)
-    return api_papers
-
-
-def get_papers_from_arxiv_rss(area: str, config: Optional[dict]) -> List[Paper]:
-    # get the feed from http://export.arxiv.org/rss/ and use the updated timestamp to avoid duplicates
-    updated = datetime.utcnow() - timedelta(days=1)
-    # format this into the string format 'Fri, 03 Nov 2023 00:30:00 GMT'
-    updated_string = updated.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    feed = feedparser.parse(
-        f"http://export.arxiv.org/rss/{area}", modified=updated_string
-    )
-    if feed.status == 304:
-        if (config is not None) and config["OUTPUT"]["debug_messages"]:
-            print("No new papers since " + updated_string + " for " + area)
-        # if there are no new papers return an empty list
-        return [], None, None
-    # get the list of entries
-    entries = feed.entries
-    if len(feed.entries) == 0:
-        print("No entries found for " + area)
-        return [], None, None
-    last_id = feed.entries[0].link.split("/")[-1]
-    # parse last modified date
-    timestamp = datetime.strptime(feed.feed["updated"], "%a, %d %b %Y %H:%M:%S +0000")
-    paper_list = []
-    for paper in entries:
+    last_key = arxiv_id_key(last_id)
+    results = arxiv.Client(page_size=page_size).results(search)
+    for index in itertools.count():
+        # the client downloads the next page when every page_size-th result is requested, so
+        # those are the calls that are timed as arxiv requests
+        if index % page_size == 0:
+            with METRICS.call("arxiv"):
+                result = next(results, None)
+        else:
+            result = next(results, None)
+        if result is None:
+            break
+        new_id = result.get_short_id().split("v")[0]
+        if arxiv_id_key(new_id) <= last_key:
+            break
+        # ignore papers not in primary area
+        if force_primary and result.primary_category != area:
+            continue
+        authors = [author.name for author in result.authors]
+        summary = unescape(result.summary.replace("\n", " "))
+        yield Paper(
+            authors=authors, title=result.title, abstract=summary, arxiv_id=new_id
+        )
+
+
+def get_papers_from_arxiv_api(area: str, timestamp, last_id) -> List[Paper]:
+    return list(iter_papers_from_arxiv_api(area, timestamp, last_id))
+
+
+def iter_rss_papers(
+    body: bytes, area: str, force_primary: bool, feed_info: dict
+) -> Iterator[Paper]:
+    # parses the RSS body one <item> at a time and yields the new papers.
+    # announce type and primary category are checked before the authors and abstract are cleaned up,
+    # and every item is cleared once handled so memory stays flat on large cross-listed feeds.
+    # feed_info is filled with the feed "updated" timestamp and the id of the first entry.
+    for _, elem in ElementTree.iterparse(io.BytesIO(body), events=("end",)):
+        if elem.tag == "lastBuildDate":
+            feed_info["updated"] = (elem.text or "").strip()
+            continue
+        if elem.tag != "item":
+            continue
+        # remove the link part of the id
+        id = (elem.findtext("link") or "").strip().split("/")[-1]
+        if "last_id" not in feed_info:
+            feed_info["last_id"] = id
         # ignore updated papers
-        if paper["arxiv_announce_type"] != "new":
+        if (elem.findtext(ARXIV_NS + "announce_type") or "").strip() != "new":
+            elem.clear()
             continue
-        # extract area
-        paper_area = paper.tags[0]["term"]
-        # ignore papers not in primary area
-        if (area != paper_area) and (config["FILTERING"].getboolean("force_primary")):
-            print(f"ignoring {paper.title}")
+        title = elem.findtext("title") or ""
+        # the first category is the primary area, ignore papers not in primary area
+        paper_area = (elem.findtext("category") or "").strip()
+        if (area != paper_area) and force_primary:
+            print(f"ignoring {title}")
+            elem.clear()
             continue
         # otherwise make a new paper, for the author field make sure to strip the HTML tags
+        creators = ", ".join(
+            creator.text or "" for creator in elem.iter(DC_NS + "creator")
+        )
         authors = [
-            unescape(re.sub("<[^<]+?>", "", author)).strip()
-            for author in paper.author.replace("\n", ", ").split(",")
+            unescape(HTML_TAG_RE.sub("", author)).strip()
+            for author in creators.replace("\n", ", ").split(",")
         ]
         # strip html tags from summary
-        summary = re.sub("<[^<]+?>", "", paper.summary)
-        summary = unescape(re.sub("\n", " ", summary))
+        summary = HTML_TAG_RE.sub("", elem.findtext("description") or "")
+        summary = unescape(summary.replace("\n", " "))
         # strip the last pair of parentehses containing (arXiv:xxxx.xxxxx [area.XX])
-        title = re.sub("\(arXiv:[0-9]+\.[0-9]+v[0-9]+ \[.*\]\)$", "", paper.title)
-        # remove the link part of the id
-        id = paper.link.split("/")[-1]
+        title = TITLE_SUFFIX_RE.sub("", title)
         # get the abstract from summary
-        abstract = summary.split('Abstract: ')[-1]
-        # make a new paper
-        new_paper = Paper(authors=authors, title=title, abstract=abstract, arxiv_id=id)
-        paper_list.append(new_paper)
+        abstract = summary.split("Abstract: ")[-1]
+        elem.clear()
+        yield Paper(authors=authors, title=title, abstract=abstract, arxiv_id=id)
 
+
+def fetch_feed(session, area: str, headers: dict, timeout: float):
+    # downloads the raw feed body. the timeout covers the whole transfer, not just a single read,
+    # so a feed that trickles in slowly is abandoned instead of holding up the run
+    start = time.monotonic()
+    with METRICS.call("arxiv"):
+        with session.get(
+            f"http://export.arxiv.org/rss/{area}",
+            headers=headers,
+            timeout=timeout,
+            stream=True,
+        ) as response:
+            if response.status_code == 304:
+                METRICS.count("not_modified", "arxiv")
+                return response, None
+            response.raise_for_status()
+            chunks = []
+            for chunk in response.iter_content(chunk_size=65536):
+                chunks.append(chunk)
+                if time.monotonic() - start > timeout:
+                    raise requests.exceptions.Timeout(
+                        "fetching " + area + " took longer than " + str(timeout) + "s"
+                    )
+            return response, b"".join(chunks)
+
+
+def get_papers_from_arxiv_rss(
+    area: str, config: Optional[dict], session=None
+) -> List[Paper]:
+    # get the feed from http://export.arxiv.org/rss/ and use the updated timestamp to avoid duplicates
+    updated = datetime.utcnow() - timedelta(days=1)
+    # format this into the string format 'Fri, 03 Nov 2023 00:30:00 GMT'
+    updated_string = updated.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    headers = {"If-Modified-Since": updated_string}
+    timeout = 30.0
+    state_store = None
+    if config is not None:
+        timeout = config["FETCHING"].getfloat("feed_timeout", fallback=timeout)
+        state_path = config["FETCHING"].get("feed_state_path", fallback="")
+        if state_path:
+            state_store = FeedStateStore(state_path)
+            # prefer the validators the server gave us last time over the one-day guess
+            headers.update(state_store.conditional_headers(area))
+    if session is None:
+        with requests.Session() as own_session:
+            response, body = fetch_feed(own_session, area, headers, timeout)
+    else:
+        response, body = fetch_feed(session, area, headers, timeout)
+    if response.status_code == 304:
+        body = None
+        # the body of a feed already downloaded today is parsed again, a feed unchanged since an
+        # earlier day has no new papers unless reuse_cached_feed is set
+        if (state_store is not None) and (
+            state_store.fetched_today(area)
+            or config["FETCHING"].getboolean("reuse_cached_feed", fallback=False)
+        ):
+            body = state_store.load_body(area)
+        if body is None:
+            if (config is not None) and config["OUTPUT"]["debug_messages"]:
+                print(
+                    "No new papers since "
+                    + headers["If-Modified-Since"]
+                    + " for "
+                    + area
+                )
+            # if there are no new papers return an empty list
+            return [], None, None
+    elif state_store is not None:
+        state_store.save(
+            area,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            body,
+        )
+    feed_info = {}
+    paper_list = list(
+        iter_rss_papers(
+            body,
+            area,
+            (config is not None) and config["FILTERING"].getboolean("force_primary"),
+            feed_info,
+        )
+    )
+    if "last_id" not in feed_info:
+        print("No entries found for " + area)
+        return [], None, None
+    last_id = feed_info["last_id"]
+    # parse last modified date
+    timestamp = datetime.strptime(feed_info["updated"], "%a, %d %b %Y %H:%M:%S +0000")
     return paper_list, timestamp, last_id
 
 
 def merge_paper_list(paper_list, api_paper_list):
-    api_set = set([paper.arxiv_id for paper in api_paper_list])
-    merged_paper_list = api_paper_list
-    for paper in paper_list:
-        if paper.arxiv_id not in api_set:
+    # api papers first, then the rss papers the api did not return, in one pass over both
+    seen_ids = set()
+    merged_paper_list = []
+    for paper in itertools.chain(api_paper_list, paper_list):
+        if paper.arxiv_id not in seen_ids:
+            seen_ids.add(paper.arxiv_id)
             merged_paper_list.append(paper)
     return merged_paper_list
 
 
-def get_papers_from_arxiv_rss_api(area: str, config: Optional[dict]) -> List[Paper]:
-    paper_list, timestamp, last_id = get_papers_from_arxiv_rss(area, config)
-    # if timestamp is None:
-    #    return []
-    # api_paper_list = get_papers_from_arxiv_api(area, timestamp, last_id)
-    # merged_paper_list = merge_paper_list(paper_list, api_paper_list)
-    # return merged_paper_list
-    return paper_list
+def get_papers_from_arxiv_rss_api(
+    area: str, config: Optional[dict], session=None
+) -> List[Paper]:
+    paper_list, timestamp, last_id = get_papers_from_arxiv_rss(area, config, session)
+    if (
+        timestamp is None
+        or config is None
+        or not config["FETCHING"].getboolean("merge_api", fallback=False)
+    ):
+        return paper_list
+    api_paper_list = []
+    try:
+        for paper in iter_papers_from_arxiv_api(
+            area,
+            timestamp,
+            last_id,
+            force_primary=config["FILTERING"].getboolean("force_primary"),
+            page_size=config["FETCHING"].getint("api_page_size", fallback=100),
+            max_results=config["FETCHING"].getint("api_max_results", fallback=1000),
+        ):
+            api_paper_list.append(paper)
+    except Exception as ex:
+        # the api only fills gaps, keep whatever it returned alongside the rss papers
+        print("Failed to query the arxiv api for " + area + ": " + str(ex))
+    return merge_paper_list(paper_list, api_paper_list)
+
+
+def get_papers_from_arxiv_concurrent(
+    area_list: List[str], config: configparser.ConfigParser
+) -> List[List[Paper]]:
+    # fetches every category in parallel over one shared connection pool.
+    # a feed that fails or times out only loses its own papers.
+    max_workers = config["FETCHING"].getint("max_concurrent_feeds", fallback=4)
+    max_workers = max(1, min(max_workers, len(area_list)))
+
+    def fetch_area(session, area):
+        try:
+            return get_papers_from_arxiv_rss_api(area, config, session)
+        except Exception as ex:
+            print("Failed to fetch " + area + ": " + str(ex))
+            return []
+
+    with requests.Session() as session:
+        # all feeds live on export.arxiv.org, so one pool sized to the worker count is enough
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda area: fetch_area(session, area), area_list))
 
 
 if __name__ == "__main__":
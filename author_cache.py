@@ -0,0 +1,109 @@
+"""
+Persistent cache of Semantic Scholar author search results, keyed by normalized author name.
+Entries expire after a configurable TTL and the least recently used ones are evicted once the
+cache grows past its size bound, so only names that miss the cache are sent to the network.
+"""
+
+import json
+import sqlite3
+import time
+
+from author_index import normalize_name_key
+from metrics import METRICS
+from storage import LOOKUP_CHUNK_SIZE, ensure_parent_dir
+
+
+class AuthorCache:
+    def __init__(self, db_path: str, ttl_days: float, max_entries: int) -> None:
+        ensure_parent_dir(db_path)
+        self.ttl_seconds = ttl_days * 24 * 3600
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS authors (
+                name TEXT PRIMARY KEY,
+                metadata TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def get_many(self, names: list[str]) -> dict:
+        # returns the cached metadata for every name with a fresh entry.
+        # a value of None means S2 had no match for the name, which is cached as well.
+        now = time.time()
+        keys = {}
+        for name in names:
+            keys.setdefault(normalize_name_key(name), []).append(name)
+        key_list = list(keys.keys())
+        found = {}
+        for i in range(0, len(key_list), LOOKUP_CHUNK_SIZE):
+            chunk = key_list[i : i + LOOKUP_CHUNK_SIZE]
+            rows = self.connection.execute(
+                "SELECT name, metadata FROM authors WHERE fetched_at >= ? AND name IN ("
+                + ",".join("?" * len(chunk))
+                + ")",
+                [now - self.ttl_seconds] + chunk,
+            )
+            for key, metadata in rows:
+                value = None if metadata is None else json.loads(metadata)
+                for name in keys[key]:
+                    found[name] = value
+            self.connection.executemany(
+                "UPDATE authors SET accessed_at = ? WHERE name = ?",
+                [(now, key) for key in chunk],
+            )
+        self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(names) - len(found)
+        METRICS.count("cache_hits", "author", len(found))
+        METRICS.count("cache_misses", "author", len(names) - len(found))
+        return found
+
+    def put_many(self, author_metadata: dict) -> None:
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO authors VALUES (?, ?, ?, ?)",
+            [
+                (
+                    normalize_name_key(name),
+                    None if metadata is None else json.dumps(metadata),
+                    now,
+                    now,
+                )
+                for name, metadata in author_metadata.items()
+            ],
+        )
+        self.connection.commit()
+
+    def items(self):
+        # yields (normalized name, metadata) for every fresh entry that has a match
+        rows = self.connection.execute(
+            "SELECT name, metadata FROM authors "
+            "WHERE fetched_at >= ? AND metadata IS NOT NULL",
+            (time.time() - self.ttl_seconds,),
+        )
+        for name, metadata in rows.fetchall():
+            yield name, json.loads(metadata)
+
+    def evict(self) -> None:
+        # drop expired entries, then the least recently used ones above max_entries
+        self.connection.execute(
+            "DELETE FROM authors WHERE fetched_at < ?",
+            (time.time() - self.ttl_seconds,),
+        )
+        self.connection.execute(
+            "DELETE FROM authors WHERE name IN ("
+            "SELECT name FROM authors ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.evict()
+        self.connection.close()
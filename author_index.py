@@ -0,0 +1,112 @@
+"""
+Local name-normalization and fuzzy-match index for author names.
+"J. Smith", "John Smith" and "John  Smith" normalize to comparable keys, so variants of one name
+collapse into a single Semantic Scholar lookup. Tracked authors from configs/authors.txt are
+matched without any network call, but only by their exact normalized name, since an initial can
+stand for several people.
+"""
+
+import unicodedata
+from typing import Optional
+
+import Levenshtein
+
+
+def normalize_name_key(name: str) -> str:
+    # strips accents and punctuation, lowercases and collapses whitespace: "J.-P. Müller" -> "j p muller"
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    cleaned = "".join(char if char.isalnum() else " " for char in stripped.lower())
+    return " ".join(cleaned.split())
+
+
+def given_names_compatible(given1: list[str], given2: list[str]) -> bool:
+    # every given name of the shorter list has to appear in order in the longer one,
+    # either spelled out or as an initial. extra middle names are allowed.
+    short, long = sorted([given1, given2], key=len)
+    if not short:
+        return not long
+    position = 0
+    for token in short:
+        while position < len(long):
+            other = long[position]
+            position += 1
+            if token == other:
+                break
+            if (len(token) == 1 and other.startswith(token)) or (
+                len(other) == 1 and token.startswith(other)
+            ):
+                break
+        else:
+            return False
+    return True
+
+
+class AuthorNameIndex:
+    def __init__(self, threshold: float = 0.95) -> None:
+        # threshold is the Levenshtein ratio above which two names with the same last name and
+        # incompatible given names still count as the same person (typos, transliterations)
+        self.threshold = threshold
+        self.values = {}
+        self.by_last_name = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def add(self, name: str, value) -> None:
+        key = normalize_name_key(name)
+        if not key:
+            return
+        if key not in self.values:
+            self.by_last_name.setdefault(key.split()[-1], []).append(key)
+        self.values[key] = value
+
+    def remove(self, name: str) -> None:
+        key = normalize_name_key(name)
+        if key not in self.values:
+            return
+        del self.values[key]
+        last_name = key.split()[-1]
+        self.by_last_name[last_name].remove(key)
+        if not self.by_last_name[last_name]:
+            del self.by_last_name[last_name]
+
+    def match(self, name: str) -> Optional[str]:
+        # returns the key of the indexed name this name refers to, or None when there is no
+        # match or several indexed people fit equally well
+        key = normalize_name_key(name)
+        if not key:
+            return None
+        if key in self.values:
+            return key
+        tokens = key.split()
+        candidates = self.by_last_name.get(tokens[-1], [])
+        compatible = [
+            candidate
+            for candidate in candidates
+            if given_names_compatible(tokens[:-1], candidate.split()[:-1])
+        ]
+        if len(compatible) == 1:
+            return compatible[0]
+        # ambiguous initials or no compatible given names: only accept a near-identical spelling
+        scored = [
+            (Levenshtein.ratio(key, candidate), candidate)
+            for candidate in (compatible or candidates)
+        ]
+        scored = [item for item in scored if item[0] >= self.threshold]
+        if not scored:
+            return None
+        scored.sort(reverse=True)
+        if len(scored) > 1 and scored[0][0] == scored[1][0]:
+            return None
+        return scored[0][1]
+
+    def get(self, name: str):
+        key = self.match(name)
+        if key is None:
+            return None
+        return self.values[key]
+
+    def get_exact(self, name: str):
+        # only the same normalized full name, no initials and no near-identical spellings
+        return self.values.get(normalize_name_key(name))
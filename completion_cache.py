@@ -0,0 +1,129 @@
+"""
+On-disk cache for chat completions, keyed by a hash of the model, prompt and sampling parameters.
+Scoring runs with a fixed temperature and seed, so a rerun after a crash or a sink failure can
+replay every title filter and scoring call from here without touching the network.
+Least recently used entries are evicted once the stored text grows past the size bound.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+from metrics import METRICS
+from storage import ensure_parent_dir
+
+
+def completion_key(model: str, prompt: str, temperature: float, seed: int) -> str:
+    payload = json.dumps(
+        {"model": model, "prompt": prompt, "temperature": temperature, "seed": seed},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def cached_completion(content: str):
+    # mimics the parts of a ChatCompletion the pipeline reads. a replayed answer costs nothing,
+    # so usage is zero
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0),
+        cached=True,
+    )
+
+
+class CompletionCache:
+    def __init__(self, db_path: str, max_bytes: int) -> None:
+        ensure_parent_dir(db_path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # completions are requested from several threads at once
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                content TEXT NOT NULL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def get(self, key: str):
+        # returns the cached completion for key, or None on a miss
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT content FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                METRICS.count("cache_misses", "completion")
+                return None
+            self.hits += 1
+            METRICS.count("cache_hits", "completion")
+            self.connection.execute(
+                "UPDATE completions SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self.connection.commit()
+        return cached_completion(row[0])
+
+    def put(self, key: str, model: str, completion) -> None:
+        content = completion.choices[0].message.content
+        usage = getattr(completion, "usage", None)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    model,
+                    content,
+                    getattr(usage, "prompt_tokens", None),
+                    getattr(usage, "completion_tokens", None),
+                    len(content.encode("utf-8")),
+                    time.time(),
+                ),
+            )
+            self.connection.commit()
+
+    def evict(self) -> None:
+        # drop the least recently used completions until the stored text fits in max_bytes
+        with self.lock:
+            total = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM completions"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self.connection.execute(
+                "SELECT key, size FROM completions ORDER BY accessed_at ASC"
+            ).fetchall()
+            evicted = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                total -= size
+            self.connection.executemany(
+                "DELETE FROM completions WHERE key = ?", evicted
+            )
+            self.connection.commit()
+
+    def close(self) -> None:
+        self.evict()
+        self.connection.close()
@@ -0,0 +1,67 @@
+"""
+Small on-disk store for the conditional-GET state of the arXiv RSS feeds.
+For every category it keeps the ETag / Last-Modified validators of the last successful fetch
+together with the raw feed body, so an unchanged feed costs one round trip and no parsing.
+"""
+
+import json
+import os
+from datetime import datetime
+from typing import Optional
+
+from storage import atomic_write
+
+
+class FeedStateStore:
+    def __init__(self, state_path: str) -> None:
+        self.state_path = state_path
+        os.makedirs(state_path, exist_ok=True)
+
+    def _path(self, area: str, suffix: str) -> str:
+        # categories look like cs.CL or stat.ML, which are safe file names already
+        return os.path.join(self.state_path, area + suffix)
+
+    def load(self, area: str) -> dict:
+        # returns the stored validators for the area, or an empty dict if it was never fetched
+        try:
+            with open(self._path(area, ".json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load_body(self, area: str) -> Optional[bytes]:
+        try:
+            with open(self._path(area, ".xml"), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def fetched_today(self, area: str) -> bool:
+        # true when the stored body was downloaded on the current UTC day. a rerun on that day
+        # gets a 304 for it but still has to see that day's papers
+        fetched_at = self.load(area).get("fetched_at") or ""
+        return fetched_at[:10] == datetime.utcnow().strftime("%Y-%m-%d")
+
+    def conditional_headers(self, area: str) -> dict:
+        # builds the If-None-Match / If-Modified-Since headers from the last successful fetch
+        state = self.load(area)
+        headers = {}
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        return headers
+
+    def save(
+        self, area: str, etag: Optional[str], last_modified: Optional[str], body: bytes
+    ) -> None:
+        # write the body first and the validators last, so validators never point at a missing body
+        with atomic_write(self._path(area, ".xml"), "wb") as f:
+            f.write(body)
+        state = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with atomic_write(self._path(area, ".json")) as f:
+            json.dump(state, f)
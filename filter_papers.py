@@ -1,18 +1,28 @@
 import configparser
 import dataclasses
 import json
+import math
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from types import SimpleNamespace
 from typing import List
 
+import numpy as np
 import retry
 from openai import OpenAI
 from tqdm import tqdm
 
 from arxiv_scraper import Paper
 from arxiv_scraper import EnhancedJSONEncoder
+from completion_cache import CompletionCache, completion_key
+from metrics import METRICS, RetryCounter
+from openai_batch import BATCH_PRICE_FACTOR, BatchClient, BatchJobState, run_batch_job
+from rate_limit import TokenBucket
 
 
-def filter_by_author(all_authors, papers, author_targets, config):
+def filter_by_author(all_authors, papers, author_targets, config, tracked_index=None):
     # filter and parse the papers
     selected_papers = {}  # pass to output
     all_papers = {}  # dict for later filtering
@@ -33,48 +43,335 @@ def filter_by_author(all_authors, papers, author_targets, config):
                             config["SELECTION"]["author_match_score"]
                         )
                         break
+            # tracked authors are also matched by their exact name, which needs no author lookup.
+            # "D. Yang" could be any Yang, so initials are not matched by name
+            if (
+                tracked_index is not None
+                and tracked_index.get_exact(author) in author_targets
+            ):
+                selected_papers[paper.arxiv_id] = {
+                    **dataclasses.asdict(paper),
+                    **{"COMMENT": "Author match"},
+                }
+                sort_dict[paper.arxiv_id] = float(
+                    config["SELECTION"]["author_match_score"]
+                )
     return selected_papers, all_papers, sort_dict
 
 
-def filter_papers_by_hindex(all_authors, papers, config):
-    # filters papers by checking to see if there's at least one author with > hcutoff hindex
+TOKEN_RE = re.compile("[a-z][a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    # lowercased word tokens with a crude plural stripping, "Scaling Laws" -> ["scaling", "law"]
+    tokens = TOKEN_RE.findall(text.lower())
+    return [
+        token[:-1]
+        if len(token) > 4 and token.endswith("s") and not token.endswith("ss")
+        else token
+        for token in tokens
+    ]
+
+
+# words that carry no topical signal in paper_topics.txt or in abstracts. they go through
+# tokenize so they match the plural stripped tokens, "studies" -> "studie"
+STOPWORDS = set(
+    tokenize(
+        """a about above after again all also an and any are as at be been before being below between
+    both but by can could did do does doing during each either etc for from further had has have
+    having how if in into is it its itself just may might more most much must no nor not of off on
+    once only or other our out over own same should so some such than that the their them then there
+    these they this those through to too under until up very via was we were what when where which
+    while who whom why will with within without would you your paper papers relevant relevance
+    propose proposed proposes study studies studied new novel method methods approach approaches
+    work works show shows result results including include includes specifically specific explicitly
+    discuss discusses provide provides detailed detail introduce introduces focus focuses using use
+    used based well like different various across existing make making better general process
+    providing support application applications user users usually aspect aspects enjoy"""
+    )
+)
+
+
+def text_terms(tokens: List[str]) -> set:
+    # unigrams and bigrams without stop words, bigrams keep phrases like "scaling law" together
+    terms = set([token for token in tokens if token not in STOPWORDS])
+    for first, second in zip(tokens, tokens[1:]):
+        if first not in STOPWORDS and second not in STOPWORDS:
+            terms.add(first + " " + second)
+    return terms
+
+
+def topic_terms(criterion: str) -> set:
+    # terms of the topic descriptions, skipping the "Not relevant" lines
+    terms = set()
+    for line in criterion.split("\n"):
+        if "not relevant" in line.lower() or "not revelant" in line.lower():
+            continue
+        terms.update(text_terms(tokenize(line)))
+    return terms
+
+
+def filter_papers_by_keywords(papers, criterion, config) -> List[Paper]:
+    # cheap local relevance prefilter: keeps papers whose title and abstract hit enough topic terms.
+    # terms found in more than keyword_max_df of the day's papers are too generic to count.
+    topic = topic_terms(criterion)
+    min_hits = config["FILTERING"].getfloat("keyword_min_hits", fallback=3)
+    max_df = config["FILTERING"].getfloat("keyword_max_df", fallback=0.2)
+    paper_terms = [
+        text_terms(tokenize(paper.title + " " + paper.abstract)) & topic
+        for paper in papers
+    ]
+    document_frequency = {}
+    for terms in paper_terms:
+        for term in terms:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    max_count = max_df * len(papers)
     paper_list = []
-    for paper in papers:
-        max_h = 0
-        for author in paper.authors:
-            if author in all_authors:
-                max_h = max(
-                    max_h, max([alias["hIndex"] for alias in all_authors[author]])
-                )
-        if max_h >= float(config["FILTERING"]["hcutoff"]):
+    for paper, terms in zip(papers, paper_terms):
+        # phrases are stronger evidence than single words
+        hits = sum(
+            2 if " " in term else 1
+            for term in terms
+            if document_frequency[term] <= max_count
+        )
+        if hits >= min_hits:
             paper_list.append(paper)
     return paper_list
 
 
+def topic_documents(criterion: str) -> List[set]:
+    # one term set per numbered topic of paper_topics.txt, without the "Not relevant" lines.
+    # a criterion without numbered topics is treated as a single topic
+    topics = []
+    for line in criterion.split("\n"):
+        if "not relevant" in line.lower() or "not revelant" in line.lower():
+            continue
+        if re.match(r"\s*\d+\.", line) or not topics:
+            topics.append(set())
+        topics[-1].update(text_terms(tokenize(line)))
+    return [terms for terms in topics if terms]
+
+
+def filter_papers_by_tfidf(papers, criterion, config) -> List[Paper]:
+    # scores every paper against every topic by tf-idf cosine similarity in one matrix product and
+    # keeps the best tfidf_keep_ratio of the papers that reach tfidf_threshold.
+    # terms are binary, only the inverse document frequency over the day's papers weights them
+    topics = topic_documents(criterion)
+    if not papers or not topics:
+        return list(papers)
+    keep_ratio = config["FILTERING"].getfloat("tfidf_keep_ratio", fallback=0.3)
+    threshold = config["FILTERING"].getfloat("tfidf_threshold", fallback=0.0)
+    paper_terms = [
+        text_terms(tokenize(paper.title + " " + paper.abstract)) for paper in papers
+    ]
+    document_frequency = {}
+    for terms in paper_terms + topics:
+        for term in terms:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    documents = len(paper_terms) + len(topics)
+    idf = {
+        term: math.log((1 + documents) / (1 + count)) + 1
+        for term, count in document_frequency.items()
+    }
+    # only topic terms contribute to the dot product, so the matrices are restricted to them.
+    # the norms still cover every term of a paper
+    vocabulary = {term: i for i, term in enumerate(sorted(set().union(*topics)))}
+    rows, columns, weights = [], [], []
+    paper_norms = np.ones(len(papers), dtype=np.float32)
+    for row, terms in enumerate(paper_terms):
+        for term in terms:
+            if term in vocabulary:
+                rows.append(row)
+                columns.append(vocabulary[term])
+                weights.append(idf[term])
+        if terms:
+            paper_norms[row] = math.sqrt(sum(idf[term] ** 2 for term in terms))
+    paper_matrix = np.zeros((len(papers), len(vocabulary)), dtype=np.float32)
+    paper_matrix[rows, columns] = weights
+    topic_matrix = np.zeros((len(topics), len(vocabulary)), dtype=np.float32)
+    for row, terms in enumerate(topics):
+        topic_matrix[row, [vocabulary[term] for term in terms]] = [
+            idf[term] for term in terms
+        ]
+    topic_norms = np.linalg.norm(topic_matrix, axis=1)
+    similarity = (paper_matrix @ topic_matrix.T) / np.outer(paper_norms, topic_norms)
+    best = similarity.max(axis=1)
+    keep = best >= threshold
+    if keep_ratio > 0:
+        ranked = np.argsort(-best, kind="stable")
+        within_ratio = np.zeros(len(papers), dtype=bool)
+        within_ratio[ranked[: math.ceil(keep_ratio * len(papers))]] = True
+        keep &= within_ratio
+    return [paper for paper, kept in zip(papers, keep) if kept]
+
+
+def prefilter_papers(papers, criterion, config) -> List[Paper]:
+    # runs the local prefilter selected by the prefilter option, none keeps every paper
+    prefilter = config["FILTERING"].get("prefilter", fallback="none")
+    if prefilter == "keyword":
+        return filter_papers_by_keywords(papers, criterion, config)
+    if prefilter == "tfidf":
+        return filter_papers_by_tfidf(papers, criterion, config)
+    return list(papers)
+
+
+def author_hindex_table(all_authors) -> dict:
+    # compiles the author lookups once into name -> highest h-index over the name's aliases
+    return {
+        author: max([alias.get("hIndex") or 0 for alias in aliases], default=0)
+        for author, aliases in all_authors.items()
+    }
+
+
+def paper_max_hindex(author_lists, hindex_table) -> np.ndarray:
+    # highest author h-index of every paper's author list in one vectorized pass, unknown
+    # authors count as 0. each segment starts with a 0 so papers without authors get one too
+    values = []
+    offsets = []
+    for authors in author_lists:
+        offsets.append(len(values))
+        values.append(0)
+        values.extend([hindex_table.get(author, 0) for author in authors])
+    if not offsets:
+        return np.zeros(0)
+    return np.maximum.reduceat(np.asarray(values, dtype=np.float64), offsets)
+
+
+def filter_papers_by_hindex(all_authors, papers, config, hindex_table=None):
+    # filters papers by checking to see if there's at least one author with > hcutoff hindex
+    if hindex_table is None:
+        hindex_table = author_hindex_table(all_authors)
+    keep = paper_max_hindex([paper.authors for paper in papers], hindex_table) >= float(
+        config["FILTERING"]["hcutoff"]
+    )
+    return [paper for paper, kept in zip(papers, keep) if kept]
+
+
+# dollars per 1000 prompt and completion tokens
+MODEL_PRICES = {
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-1106": (0.0015, 0.002),
+    "gpt-4o-2024-05-13": (0.01, 0.03),
+}
+unpriced_models = set()
+
+
 def calc_price(model, usage):
-    if model == "gpt-4-1106-preview":
-        return (0.01 * usage.prompt_tokens + 0.03 * usage.completion_tokens) / 1000.0
-    if model == "gpt-4":
-        return (0.03 * usage.prompt_tokens + 0.06 * usage.completion_tokens) / 1000.0
-    if (model == "gpt-3.5-turbo") or (model == "gpt-3.5-turbo-1106"):
-        return (0.0015 * usage.prompt_tokens + 0.002 * usage.completion_tokens) / 1000.0
-    if model == "gpt-4o-2024-05-13":
-        return (0.01 * usage.prompt_tokens + 0.03 * usage.completion_tokens) / 1000.0
-
-
-@retry.retry(tries=3, delay=2)
-def call_chatgpt(full_prompt, openai_client, model):
-    return openai_client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": full_prompt}],
-        temperature=0.0,
-        seed=0,
+    # models without a known price count as free, with one warning per model, so that cost
+    # sums keep working. their tokens are still recorded in the run metrics
+    if model not in MODEL_PRICES:
+        if model not in unpriced_models:
+            unpriced_models.add(model)
+            print("Warning: no price known for model " + str(model) + ", counting $0")
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICES[model]
+    return (
+        prompt_price * usage.prompt_tokens + completion_price * usage.completion_tokens
+    ) / 1000.0
+
+
+def track_cost(model, usage, price_factor=1.0):
+    # the cost of one completion, recorded with its tokens in the run metrics
+    cost = calc_price(model, usage) * price_factor
+    METRICS.record_usage(model, usage.prompt_tokens, usage.completion_tokens, cost)
+    return cost
+
+
+def estimate_tokens(text: str) -> int:
+    # rough token count for english text, about four characters per token
+    return len(text) // 4 + 1
+
+
+def make_token_bucket(config):
+    # paces requests to the tokens-per-minute limit of the account, None when unlimited
+    tokens_per_minute = config["SELECTION"].getfloat("tokens_per_minute", fallback=0)
+    if tokens_per_minute <= 0:
+        return None
+    return TokenBucket(tokens_per_minute / 60.0, capacity=tokens_per_minute)
+
+
+def make_request_slots(config):
+    # bounds the requests in flight to max_concurrent_requests across every thread that shares it
+    max_requests = config["SELECTION"].getint("max_concurrent_requests", fallback=1)
+    return threading.BoundedSemaphore(max(1, max_requests))
+
+
+def request_slot(request_slots):
+    # holds one of the shared request slots, or nothing when requests are not bounded
+    return request_slots if request_slots is not None else nullcontext()
+
+
+def run_concurrently(fn, items, config):
+    # runs fn on every item with at most max_concurrent_requests calls in flight.
+    # results come back in the order of items, so the output does not depend on timing
+    max_workers = config["SELECTION"].getint("max_concurrent_requests", fallback=1)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return list(tqdm(executor.map(fn, items), total=len(items)))
+
+
+def make_completion_cache(config):
+    if not config["CACHE"].get("completion_cache_path", fallback=""):
+        return None
+    return CompletionCache(
+        config["CACHE"]["completion_cache_path"],
+        int(config["CACHE"].getfloat("completion_cache_max_mb", fallback=200) * 2**20),
     )
 
 
-def run_and_parse_chatgpt(full_prompt, openai_client, config):
+@retry.retry(tries=3, delay=2, logger=RetryCounter(METRICS, "openai"))
+def call_chatgpt(
+    full_prompt,
+    openai_client,
+    model,
+    token_bucket=None,
+    completion_cache=None,
+    temperature=0.0,
+    seed=0,
+    request_slots=None,
+):
+    # answers from the completion cache when this exact request was made before
+    if completion_cache is not None:
+        key = completion_key(model, full_prompt, temperature, seed)
+        completion = completion_cache.get(key)
+        if completion is not None:
+            return completion
+    if token_bucket is not None:
+        token_bucket.acquire(estimate_tokens(full_prompt))
+    with request_slot(request_slots), METRICS.call("openai"):
+        completion = openai_client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": full_prompt}],
+            temperature=temperature,
+            seed=seed,
+        )
+    if completion_cache is not None:
+        completion_cache.put(key, model, completion)
+    return completion
+
+
+def run_and_parse_chatgpt(
+    full_prompt,
+    openai_client,
+    config,
+    token_bucket=None,
+    completion_cache=None,
+    temperature=0.0,
+    seed=0,
+    request_slots=None,
+):
     # just runs the chatgpt prompt, tries to parse the resulting JSON
-    completion = call_chatgpt(full_prompt, openai_client, config["SELECTION"]["model"])
+    completion = call_chatgpt(
+        full_prompt,
+        openai_client,
+        config["SELECTION"]["model"],
+        token_bucket,
+        completion_cache,
+        temperature,
+        seed,
+        request_slots,
+    )
     out_text = completion.choices[0].message.content
     out_text = re.sub("```jsonl\n", "", out_text)
     out_text = re.sub("```", "", out_text)
@@ -94,7 +391,216 @@ def run_and_parse_chatgpt(full_prompt, openai_client, config):
                 print("RAW output")
                 print(completion.choices[0].message.content)
             continue
-    return json_dicts, calc_price(config["SELECTION"]["model"], completion.usage)
+    return json_dicts, track_cost(config["SELECTION"]["model"], completion.usage)
+
+
+def parse_score_line(line: str):
+    # parses one line of a JSONL answer, None for code fences, blank lines and broken lines
+    line = line.strip()
+    if line.startswith("```"):
+        return None
+    if line.endswith("},"):
+        line = line[:-1]
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+@retry.retry(tries=3, delay=2, logger=RetryCounter(METRICS, "openai"))
+def open_completion_stream(
+    full_prompt, openai_client, model, token_bucket=None, seed=0
+):
+    # only opening the stream is retried, a retry halfway through would repeat scores
+    if token_bucket is not None:
+        token_bucket.acquire(estimate_tokens(full_prompt))
+    with METRICS.call("openai"):
+        return openai_client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": full_prompt}],
+            temperature=0.0,
+            seed=seed,
+            stream=True,
+        )
+
+
+def stream_and_parse_chatgpt(
+    full_prompt,
+    openai_client,
+    config,
+    token_bucket=None,
+    completion_cache=None,
+    on_result=None,
+    seed=0,
+    request_slots=None,
+):
+    # streams the completion and parses each JSONL line as soon as it is complete, on_result is
+    # called with every score as it arrives. when the stream breaks off, the scores parsed so
+    # far are kept and the truncated answer is not cached. the request slot is held until the
+    # whole answer has arrived
+    model = config["SELECTION"]["model"]
+    json_dicts = []
+
+    def handle_line(line):
+        jdict = parse_score_line(line)
+        if jdict is None:
+            return
+        json_dicts.append(jdict)
+        if on_result is not None:
+            on_result(jdict)
+
+    if completion_cache is not None:
+        key = completion_key(model, full_prompt, 0.0, seed)
+        completion = completion_cache.get(key)
+        if completion is not None:
+            for line in completion.choices[0].message.content.split("\n"):
+                handle_line(line)
+            return json_dicts, track_cost(model, completion.usage)
+    pieces = []
+    buffer = ""
+    complete = False
+    try:
+        with request_slot(request_slots):
+            stream = open_completion_stream(
+                full_prompt, openai_client, model, token_bucket, seed
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content or ""
+                pieces.append(content)
+                buffer += content
+                while "\n" in buffer:
+                    line, buffer = buffer.split("\n", 1)
+                    handle_line(line)
+        complete = True
+    except Exception as ex:
+        print(
+            "Completion stream broke off after "
+            + str(len(json_dicts))
+            + " scores: "
+            + str(ex)
+        )
+    # the last line has no newline. a line cut off by a broken stream fails to parse
+    handle_line(buffer)
+    text = "".join(pieces)
+    # streamed responses carry no usage, so the cost is estimated from the text
+    usage = SimpleNamespace(
+        prompt_tokens=estimate_tokens(full_prompt),
+        completion_tokens=estimate_tokens(text),
+    )
+    if complete and completion_cache is not None:
+        completion_cache.put(
+            key,
+            model,
+            SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+                usage=usage,
+            ),
+        )
+    return json_dicts, track_cost(model, usage)
+
+
+def samples_agree(samples, tolerance) -> bool:
+    # true when every paper got RELEVANCE and NOVELTY scores within tolerance in every sample.
+    # samples only hold scores that passed valid_score
+    scores = {}
+    for json_dicts in samples:
+        for jdict in json_dicts:
+            scores.setdefault(jdict["ARXIVID"], []).append(jdict)
+    for jdicts in scores.values():
+        if len(jdicts) < len(samples):
+            return False
+        for field in ["RELEVANCE", "NOVELTY"]:
+            values = [float(jdict[field]) for jdict in jdicts]
+            if max(values) - min(values) > tolerance:
+                return False
+    return True
+
+
+def average_samples(samples):
+    # one entry per paper with RELEVANCE and NOVELTY averaged over the samples that scored it,
+    # the comment and any other field come from the first of those samples. samples only hold
+    # scores that passed valid_score
+    averaged = {}
+    scores = {}
+    for json_dicts in samples:
+        for jdict in json_dicts:
+            averaged.setdefault(jdict["ARXIVID"], dict(jdict))
+            scores.setdefault(jdict["ARXIVID"], []).append(jdict)
+    for arxiv_id, jdicts in scores.items():
+        for field in ["RELEVANCE", "NOVELTY"]:
+            averaged[arxiv_id][field] = sum(
+                [float(jdict[field]) for jdict in jdicts]
+            ) / len(jdicts)
+    return list(averaged.values())
+
+
+def run_and_average_samples(
+    full_prompt,
+    openai_client,
+    config,
+    token_bucket=None,
+    completion_cache=None,
+    first_seed=0,
+    request_slots=None,
+):
+    # draws num_samples samples, the first min_agreeing_samples of them at the same time.
+    # when those already agree within sample_tolerance the remaining samples are skipped,
+    # otherwise they are drawn at once as well. samples use consecutive seeds from first_seed
+    num_samples = config["FILTERING"].getint("num_samples", fallback=1)
+    temperature = config["FILTERING"].getfloat("sample_temperature", fallback=0.7)
+    min_agreeing = min(
+        num_samples, config["FILTERING"].getint("min_agreeing_samples", fallback=2)
+    )
+    tolerance = config["FILTERING"].getfloat("sample_tolerance", fallback=1.0)
+
+    def draw_sample(seed):
+        # keeps only the valid scores of the answer. a sample whose request fails is None,
+        # the cost of the other samples of the draw still counts
+        try:
+            json_dicts, cost = run_and_parse_chatgpt(
+                full_prompt,
+                openai_client,
+                config,
+                token_bucket,
+                completion_cache,
+                temperature,
+                seed,
+                request_slots,
+            )
+        except Exception as ex:
+            print("Sample request failed: " + str(ex))
+            return None, 0
+        return [jdict for jdict in json_dicts if valid_score(jdict)], cost
+
+    def draw(seeds):
+        # the samples run in parallel, pass request_slots to keep them within the in-flight limit
+        # shared with the other scoring batches
+        with ThreadPoolExecutor(max_workers=len(seeds)) as executor:
+            return list(executor.map(draw_sample, seeds))
+
+    results = draw(list(range(first_seed, first_seed + min_agreeing)))
+    samples = [json_dicts for json_dicts, _ in results if json_dicts is not None]
+    if min_agreeing < num_samples and (
+        len(samples) < min_agreeing or not samples_agree(samples, tolerance)
+    ):
+        results += draw(
+            list(range(first_seed + min_agreeing, first_seed + num_samples))
+        )
+    samples = [json_dicts for json_dicts, _ in results if json_dicts is not None]
+    cost = sum([cost for _, cost in results])
+    if config["OUTPUT"].getboolean("debug_messages") and len(results) < num_samples:
+        print(
+            "Samples agreed after "
+            + str(len(results))
+            + " of "
+            + str(num_samples)
+            + " draws"
+        )
+    return average_samples(samples), cost
 
 
 def paper_to_string(paper_entry: Paper) -> str:
@@ -120,34 +626,133 @@ def batched(items, batch_size):
     return [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
 
 
+def token_batched(items, render, fixed_tokens, token_budget, max_items):
+    # packs items in order into batches whose prompt stays within token_budget, counting the
+    # fixed_tokens of the surrounding prompt, with at most max_items per batch.
+    # an item that alone exceeds the budget gets a batch of its own. a budget of 0 batches by count
+    max_items = max(1, max_items)
+    if token_budget <= 0:
+        return batched(items, max_items)
+    batches = []
+    current = []
+    current_tokens = fixed_tokens
+    for item in items:
+        tokens = estimate_tokens(render(item))
+        if current and (
+            len(current) >= max_items or current_tokens + tokens > token_budget
+        ):
+            batches.append(current)
+            current = []
+            current_tokens = fixed_tokens
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+TITLE_FILTER_POSTFIX = 'Identify any papers that are absolutely and completely irrelavent to the criteria, and you are absolutely sure your friend will not enjoy, formatted as a list of arxiv ids like ["ID1", "ID2", "ID3"..]. Be extremely cautious, and if you are unsure at all, do not add a paper in this list. You will check it in detail later.\n Directly respond with the list, do not add ANY extra text before or after the list. Even if every paper seems irrelevant, please keep at least TWO papers'
+
+
+def title_prompt(batch, base_prompt, criterion) -> str:
+    papers_string = "".join([paper_to_titles(paper) for paper in batch])
+    return base_prompt + "\n " + criterion + "\n" + papers_string + TITLE_FILTER_POSTFIX
+
+
+def title_batches(papers, config, base_prompt, criterion):
+    return token_batched(
+        papers,
+        paper_to_titles,
+        estimate_tokens(base_prompt + criterion + TITLE_FILTER_POSTFIX),
+        config["SELECTION"].getint("title_batch_token_budget", fallback=0),
+        config["SELECTION"].getint("title_batch_size", fallback=20),
+    )
+
+
 def filter_papers_by_title(
-    papers, config, openai_client, base_prompt, criterion
+    papers,
+    config,
+    openai_client,
+    base_prompt,
+    criterion,
+    token_bucket=None,
+    completion_cache=None,
+    request_slots=None,
 ) -> List[Paper]:
-    filter_postfix = 'Identify any papers that are absolutely and completely irrelavent to the criteria, and you are absolutely sure your friend will not enjoy, formatted as a list of arxiv ids like ["ID1", "ID2", "ID3"..]. Be extremely cautious, and if you are unsure at all, do not add a paper in this list. You will check it in detail later.\n Directly respond with the list, do not add ANY extra text before or after the list. Even if every paper seems irrelevant, please keep at least TWO papers'
-    batches_of_papers = batched(papers, 20)
-    final_list = []
-    cost = 0
-    for batch in batches_of_papers:
-        papers_string = "".join([paper_to_titles(paper) for paper in batch])
-        full_prompt = (
-            base_prompt + "\n " + criterion + "\n" + papers_string + filter_postfix
-        )
-        model = config["SELECTION"]["model"]
-        completion = call_chatgpt(full_prompt, openai_client, model)
-        cost += calc_price(model, completion.usage)
+    batches_of_papers = title_batches(papers, config, base_prompt, criterion)
+    model = config["SELECTION"]["model"]
+    max_retries = config["SELECTION"].getint("paper_retries", fallback=2)
+
+    def run_title_batch(batch, seed):
+        # returns the ids the model filtered out, or None when the answer is unusable
+        full_prompt = title_prompt(batch, base_prompt, criterion)
+        try:
+            completion = call_chatgpt(
+                full_prompt,
+                openai_client,
+                model,
+                token_bucket,
+                completion_cache,
+                seed=seed,
+                request_slots=request_slots,
+            )
+        except Exception as ex:
+            print("Title filter request failed: " + str(ex))
+            return None, 0
+        cost = track_cost(model, completion.usage)
         out_text = completion.choices[0].message.content
         try:
-            filtered_set = set(json.loads(out_text))
-            for paper in batch:
-                if paper.arxiv_id not in filtered_set:
-                    final_list.append(paper)
-                else:
-                    print("Filtered out paper " + paper.arxiv_id)
+            filtered = json.loads(out_text)
+            if not isinstance(filtered, list):
+                raise ValueError("not a list")
+            return set([str(arxiv_id) for arxiv_id in filtered]), cost
         except Exception as ex:
             print("Exception happened " + str(ex))
             print("Failed to parse LM output as list " + out_text)
             print(completion)
-            continue
+            return None, cost
+
+    def filter_title_batch(batch):
+        # a batch with an unusable answer is split in halves and sent again. papers that still
+        # fail after paper_retries retries are kept, they are scored in detail later anyway
+        filtered_set = set()
+        cost = 0
+        queue = [(batch, 0)]
+        while queue:
+            part, attempt = queue.pop(0)
+            filtered, part_cost = run_title_batch(part, attempt)
+            cost += part_cost
+            if filtered is not None:
+                filtered_set.update(filtered)
+            elif attempt < max_retries:
+                METRICS.count("retries", "title_filter")
+                if len(part) > 1:
+                    half = len(part) // 2
+                    queue += [(part[:half], attempt + 1), (part[half:], attempt + 1)]
+                else:
+                    queue.append((part, attempt + 1))
+            else:
+                METRICS.count("given_up", "title_filter", len(part))
+                print(
+                    "Keeping "
+                    + str(len(part))
+                    + " papers the title filter could not judge"
+                )
+        kept = []
+        for paper in batch:
+            if paper.arxiv_id not in filtered_set:
+                kept.append(paper)
+            else:
+                print("Filtered out paper " + paper.arxiv_id)
+        return kept, cost
+
+    final_list = []
+    cost = 0
+    for kept, batch_cost in run_concurrently(
+        filter_title_batch, batches_of_papers, config
+    ):
+        final_list.extend(kept)
+        cost += batch_cost
     return final_list, cost
 
 
@@ -155,11 +760,9 @@ def paper_to_titles(paper_entry: Paper) -> str:
     return "ArXiv ID: " + paper_entry.arxiv_id + " Title: " + paper_entry.title + "\n"
 
 
-def run_on_batch(
-    paper_batch, base_prompt, criterion, postfix_prompt, openai_client, config
-):
+def scoring_prompt(paper_batch, base_prompt, criterion, postfix_prompt) -> str:
     batch_str = [paper_to_string(paper) for paper in paper_batch]
-    full_prompt = "\n".join(
+    return "\n".join(
         [
             base_prompt,
             criterion + "\n",
@@ -167,29 +770,305 @@ def run_on_batch(
             postfix_prompt,
         ]
     )
-    json_dicts, cost = run_and_parse_chatgpt(full_prompt, openai_client, config)
+
+
+def scoring_batches(papers, config, base_prompt, criterion, postfix_prompt):
+    return token_batched(
+        papers,
+        paper_to_string,
+        estimate_tokens(base_prompt + criterion + postfix_prompt),
+        config["SELECTION"].getint("batch_token_budget", fallback=0),
+        int(config["SELECTION"]["batch_size"]),
+    )
+
+
+def first_scoring_samples(config):
+    # (temperature, seed) of the requests score_batch sends first for a batch: one greedy
+    # request, or the first min_agreeing_samples samples when num_samples > 1
+    num_samples = config["FILTERING"].getint("num_samples", fallback=1)
+    if num_samples <= 1:
+        return [(0.0, 0)]
+    temperature = config["FILTERING"].getfloat("sample_temperature", fallback=0.7)
+    min_agreeing = min(
+        num_samples, config["FILTERING"].getint("min_agreeing_samples", fallback=2)
+    )
+    return [(temperature, seed) for seed in range(min_agreeing)]
+
+
+def prefetch_by_batch(
+    phase, prompts, openai_client, config, completion_cache, samples=((0.0, 0),)
+):
+    # sends the prompts that are not cached yet as one offline batch job and caches the answers,
+    # so the live flow afterwards finds them there. every prompt is sent once per
+    # (temperature, seed) in samples, keyed like the live request. returns the cost of the batch
+    model = config["SELECTION"]["model"]
+    missing = {}
+    for prompt in prompts:
+        for temperature, seed in samples:
+            key = completion_key(model, prompt, temperature, seed)
+            if key not in completion_cache:
+                missing[key] = (prompt, temperature, seed)
+    client = BatchClient(openai_client.base_url, openai_client.api_key)
+    try:
+        completions = run_batch_job(
+            phase,
+            missing,
+            model,
+            client,
+            BatchJobState(
+                config["SELECTION"].get(
+                    "batch_state_path", fallback="out/batch/state.json"
+                )
+            ),
+            config,
+        )
+    finally:
+        client.close()
+    cost = 0
+    for key, completion in completions.items():
+        completion_cache.put(key, model, completion)
+        cost += track_cost(model, completion.usage, BATCH_PRICE_FACTOR)
+    if config["OUTPUT"].getboolean("debug_messages"):
+        print(
+            phase
+            + " batch answered "
+            + str(len(completions))
+            + " of "
+            + str(len(missing))
+            + " requests"
+        )
+    return cost
+
+
+def valid_score(jdict) -> bool:
+    # a usable score names a paper and carries numeric RELEVANCE and NOVELTY values, which may
+    # still be strings like "9"
+    if not isinstance(jdict, dict) or not isinstance(jdict.get("ARXIVID"), str):
+        return False
+    try:
+        float(jdict["RELEVANCE"])
+        float(jdict["NOVELTY"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return True
+
+
+def score_batch(
+    paper_batch,
+    base_prompt,
+    criterion,
+    postfix_prompt,
+    openai_client,
+    config,
+    token_bucket=None,
+    completion_cache=None,
+    on_result=None,
+    seed=0,
+    request_slots=None,
+):
+    # one scoring request for the batch, on_result is called with every score as soon as it is
+    # known. the seed changes on retries so that a cached bad answer is not replayed
+    full_prompt = scoring_prompt(paper_batch, base_prompt, criterion, postfix_prompt)
+    num_samples = config["FILTERING"].getint("num_samples", fallback=1)
+    if num_samples > 1:
+        json_dicts, cost = run_and_average_samples(
+            full_prompt,
+            openai_client,
+            config,
+            token_bucket,
+            completion_cache,
+            seed * num_samples,
+            request_slots,
+        )
+    elif config["SELECTION"].getboolean("stream_completions", fallback=False):
+        return stream_and_parse_chatgpt(
+            full_prompt,
+            openai_client,
+            config,
+            token_bucket,
+            completion_cache,
+            on_result,
+            seed,
+            request_slots,
+        )
+    else:
+        json_dicts, cost = run_and_parse_chatgpt(
+            full_prompt,
+            openai_client,
+            config,
+            token_bucket,
+            completion_cache,
+            seed=seed,
+            request_slots=request_slots,
+        )
+    if on_result is not None:
+        for jdict in json_dicts:
+            on_result(jdict)
     return json_dicts, cost
 
 
+def run_on_batch(
+    paper_batch,
+    base_prompt,
+    criterion,
+    postfix_prompt,
+    openai_client,
+    config,
+    token_bucket=None,
+    completion_cache=None,
+    on_result=None,
+    request_slots=None,
+):
+    # scores the batch and checks the returned ARXIVIDs against it. only papers that are missing
+    # from the answer or got an invalid score are sent again, and a request that scores nothing
+    # is split in halves. every paper is retried at most paper_retries times
+    max_retries = config["SELECTION"].getint("paper_retries", fallback=2)
+    retries = {paper.arxiv_id: 0 for paper in paper_batch}
+    remaining = set(retries)
+    json_dicts = []
+    cost = 0
+
+    def accept(jdict):
+        # ignores invalid scores, papers from outside the batch and repeated scores. scores sent
+        # as strings are converted, so on_result can compare them against the cutoffs
+        if valid_score(jdict) and jdict["ARXIVID"] in remaining:
+            for field in ["RELEVANCE", "NOVELTY"]:
+                if isinstance(jdict[field], str):
+                    jdict[field] = float(jdict[field])
+            remaining.discard(jdict["ARXIVID"])
+            json_dicts.append(jdict)
+            if on_result is not None:
+                on_result(jdict)
+
+    queue = [(list(paper_batch), 0)]
+    while queue:
+        batch, seed = queue.pop(0)
+        try:
+            _, batch_cost = score_batch(
+                batch,
+                base_prompt,
+                criterion,
+                postfix_prompt,
+                openai_client,
+                config,
+                token_bucket,
+                completion_cache,
+                accept,
+                seed,
+                request_slots,
+            )
+            cost += batch_cost
+        except Exception as ex:
+            print("Scoring request failed: " + str(ex))
+        missing = [paper for paper in batch if paper.arxiv_id in remaining]
+        retry_papers = []
+        for paper in missing:
+            retries[paper.arxiv_id] += 1
+            if retries[paper.arxiv_id] <= max_retries:
+                retry_papers.append(paper)
+            else:
+                METRICS.count("given_up", "scoring")
+                print("Giving up on scoring paper " + paper.arxiv_id)
+        if not retry_papers:
+            continue
+        METRICS.count("retries", "scoring", len(retry_papers))
+        if len(missing) == len(batch) and len(retry_papers) > 1:
+            half = len(retry_papers) // 2
+            queue += [(retry_papers[:half], seed + 1), (retry_papers[half:], seed + 1)]
+        else:
+            queue.append((retry_papers, seed + 1))
+    return json_dicts, cost
+
+
+def make_score_selector(
+    config, all_papers, selected_papers, sort_dict, scored_papers, lock=None
+):
+    # returns the on_result callback of run_on_batch, which records every score as soon as it
+    # arrives, from several batches at once. callers that touch the same dicts pass their lock
+    if lock is None:
+        lock = threading.Lock()
+
+    def select_scored_paper(jdict):
+        with lock:
+            if (
+                int(jdict["RELEVANCE"]) >= int(config["FILTERING"]["relevance_cutoff"])
+                and jdict["NOVELTY"] >= int(config["FILTERING"]["novelty_cutoff"])
+                and jdict["ARXIVID"] in all_papers
+            ):
+                selected_papers[jdict["ARXIVID"]] = {
+                    **dataclasses.asdict(all_papers[jdict["ARXIVID"]]),
+                    **jdict,
+                }
+                sort_dict[jdict["ARXIVID"]] = jdict["RELEVANCE"] + jdict["NOVELTY"]
+            if jdict["ARXIVID"] in all_papers:
+                scored_papers[jdict["ARXIVID"]] = jdict
+
+    return select_scored_paper
+
+
 def filter_by_gpt(
-    all_authors, papers, config, openai_client, all_papers, selected_papers, sort_dict
+    all_authors,
+    papers,
+    config,
+    openai_client,
+    all_papers,
+    selected_papers,
+    sort_dict,
+    hindex_table=None,
+    criterion=None,
+    route=None,
 ):
+    # route, when given, takes the papers that passed the h-index and title filters and returns
+    # the ones GPT still has to score, e.g. the ones the local scorer is not confident about.
     # deal with config parsing
     with open("configs/base_prompt.txt", "r") as f:
         base_prompt = f.read()
-    with open("configs/paper_topics.txt", "r") as f:
-        criterion = f.read()
+    # profiles pass their own topics, otherwise the configured ones are used
+    if criterion is None:
+        with open("configs/paper_topics.txt", "r") as f:
+            criterion = f.read()
     with open("configs/postfix_prompt.txt", "r") as f:
         postfix_prompt = f.read()
     all_cost = 0
+    # scores per arxiv id, None marks papers that were dropped before scoring
+    scored_papers = {}
     if config["SELECTION"].getboolean("run_openai"):
+        # shared by the title filter and the scoring calls, both count against the same limits.
+        # the request slots also cover the samples each scoring batch draws at the same time
+        token_bucket = make_token_bucket(config)
+        request_slots = make_request_slots(config)
+        completion_cache = make_completion_cache(config)
+        # batch mode hands the batch answers to the live flow through the completion cache
+        batch_mode = config["SELECTION"].getboolean("batch_mode", fallback=False)
+        if batch_mode and completion_cache is None:
+            completion_cache = CompletionCache(":memory:", 0)
         # filter first by hindex of authors to reduce costs.
-        paper_list = filter_papers_by_hindex(all_authors, papers, config)
+        paper_list = filter_papers_by_hindex(all_authors, papers, config, hindex_table)
         if config["OUTPUT"].getboolean("debug_messages"):
             print(str(len(paper_list)) + " papers after hindex filtering")
         cost = 0
+        if batch_mode:
+            all_cost += prefetch_by_batch(
+                "title",
+                [
+                    title_prompt(batch, base_prompt, criterion)
+                    for batch in title_batches(
+                        paper_list, config, base_prompt, criterion
+                    )
+                ],
+                openai_client,
+                config,
+                completion_cache,
+            )
         paper_list, cost = filter_papers_by_title(
-            paper_list, config, openai_client, base_prompt, criterion
+            paper_list,
+            config,
+            openai_client,
+            base_prompt,
+            criterion,
+            token_bucket,
+            completion_cache,
+            request_slots,
         )
         if config["OUTPUT"].getboolean("debug_messages"):
             print(
@@ -198,28 +1077,60 @@ def filter_by_gpt(
                 + str(cost)
             )
         all_cost += cost
+        if route is not None:
+            paper_list = route(paper_list)
+        kept_ids = set([paper.arxiv_id for paper in paper_list])
+        for paper in papers:
+            if paper.arxiv_id not in kept_ids:
+                scored_papers[paper.arxiv_id] = None
 
         # batch the remaining papers and invoke GPT
-        batch_of_papers = batched(paper_list, int(config["SELECTION"]["batch_size"]))
+        batch_of_papers = scoring_batches(
+            paper_list, config, base_prompt, criterion, postfix_prompt
+        )
+        if batch_mode:
+            all_cost += prefetch_by_batch(
+                "scoring",
+                [
+                    scoring_prompt(batch, base_prompt, criterion, postfix_prompt)
+                    for batch in batch_of_papers
+                ],
+                openai_client,
+                config,
+                completion_cache,
+                first_scoring_samples(config),
+            )
+        if config["OUTPUT"].getboolean("debug_messages"):
+            print(
+                str(len(paper_list))
+                + " papers in "
+                + str(len(batch_of_papers))
+                + " scoring batches"
+            )
+        select_scored_paper = make_score_selector(
+            config, all_papers, selected_papers, sort_dict, scored_papers
+        )
         scored_batches = []
-        for batch in tqdm(batch_of_papers):
+        batch_results = run_concurrently(
+            lambda batch: run_on_batch(
+                batch,
+                base_prompt,
+                criterion,
+                postfix_prompt,
+                openai_client,
+                config,
+                token_bucket,
+                completion_cache,
+                select_scored_paper,
+                request_slots,
+            ),
+            batch_of_papers,
+            config,
+        )
+        for json_dicts, cost in batch_results:
             scored_in_batch = []
-            json_dicts, cost = run_on_batch(
-                batch, base_prompt, criterion, postfix_prompt, openai_client, config
-            )
             all_cost += cost
             for jdict in json_dicts:
-                if (
-                    int(jdict["RELEVANCE"])
-                    >= int(config["FILTERING"]["relevance_cutoff"])
-                    and jdict["NOVELTY"] >= int(config["FILTERING"]["novelty_cutoff"])
-                    and jdict["ARXIVID"] in all_papers
-                ):
-                    selected_papers[jdict["ARXIVID"]] = {
-                        **dataclasses.asdict(all_papers[jdict["ARXIVID"]]),
-                        **jdict,
-                    }
-                    sort_dict[jdict["ARXIVID"]] = jdict["RELEVANCE"] + jdict["NOVELTY"]
                 scored_in_batch.append(
                     {
                         **dataclasses.asdict(all_papers[jdict["ARXIVID"]]),
@@ -232,8 +1143,19 @@ def filter_by_gpt(
                 config["OUTPUT"]["output_path"] + "gpt_paper_batches.debug.json", "w"
             ) as outfile:
                 json.dump(scored_batches, outfile, cls=EnhancedJSONEncoder, indent=4)
+        if completion_cache is not None:
+            if config["OUTPUT"].getboolean("debug_messages"):
+                print(
+                    "Completion cache: "
+                    + str(completion_cache.hits)
+                    + " hits, "
+                    + str(completion_cache.misses)
+                    + " misses"
+                )
+            completion_cache.close()
         if config["OUTPUT"].getboolean("debug_messages"):
             print("Total cost: $" + str(all_cost))
+    return scored_papers
 
 
 if __name__ == "__main__":
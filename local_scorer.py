@@ -0,0 +1,249 @@
+"""
+Local CPU scorer distilled from the GPT scores of earlier runs.
+A ridge regression over hashed unigram and bigram features of title and abstract predicts RELEVANCE
+and NOVELTY. Papers it is confident about are dropped or selected locally, only the uncertain
+middle band is sent to GPT.
+It is trained on the scored papers of the paper store and on gpt_paper_batches.debug.json dumps.
+GPT only scores papers that passed the prefilter, the h-index filter and the title filter, so the
+model never sees the papers dropped before scoring and its predictions only mean something for
+papers that passed those filters as well. main.py therefore routes papers after them.
+
+usage: python local_scorer.py train [--dumps out/gpt_paper_batches.debug.json ...]
+       python local_scorer.py eval [--dumps ...]
+"""
+
+import argparse
+import configparser
+import dataclasses
+import json
+import os
+import zlib
+from typing import List, Tuple
+
+import numpy as np
+
+from arxiv_scraper import Paper
+from filter_papers import text_terms, tokenize
+from paper_store import PaperStore
+from storage import atomic_write, ensure_parent_dir
+
+# rows are featurized in chunks so the dense feature matrix of a large history never exists at once
+FEATURE_CHUNK_SIZE = 2000
+
+
+def paper_features(papers: List[Paper], hash_dim: int) -> np.ndarray:
+    # binary unigram and bigram features hashed into hash_dim columns, rows scaled to unit length.
+    # crc32 is stable across processes, unlike the builtin hash
+    features = np.zeros((len(papers), hash_dim), dtype=np.float32)
+    for row, paper in enumerate(papers):
+        terms = text_terms(tokenize(paper.title + " " + paper.abstract))
+        columns = [zlib.crc32(term.encode("utf-8")) % hash_dim for term in terms]
+        np.add.at(features[row], columns, 1.0)
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.maximum(norms, 1e-6)
+
+
+class LocalScorer:
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, hash_dim: int) -> None:
+        # weights has one column per predicted score: RELEVANCE and NOVELTY
+        self.weights = weights
+        self.bias = bias
+        self.hash_dim = hash_dim
+
+    @classmethod
+    def fit(
+        cls, papers: List[Paper], scores: np.ndarray, hash_dim: int, alpha: float
+    ) -> "LocalScorer":
+        # closed form ridge regression, X^T X is accumulated chunk by chunk
+        bias = scores.mean(axis=0)
+        gram = np.zeros((hash_dim, hash_dim), dtype=np.float64)
+        moment = np.zeros((hash_dim, scores.shape[1]), dtype=np.float64)
+        for i in range(0, len(papers), FEATURE_CHUNK_SIZE):
+            features = paper_features(papers[i : i + FEATURE_CHUNK_SIZE], hash_dim)
+            gram += features.T @ features
+            moment += features.T @ (scores[i : i + FEATURE_CHUNK_SIZE] - bias)
+        gram[np.diag_indices(hash_dim)] += alpha
+        weights = np.linalg.solve(gram, moment).astype(np.float32)
+        return cls(weights, bias.astype(np.float32), hash_dim)
+
+    def predict(self, papers: List[Paper]) -> np.ndarray:
+        # one row per paper holding the predicted RELEVANCE and NOVELTY
+        if not papers:
+            return np.zeros((0, 2), dtype=np.float32)
+        return np.concatenate(
+            [
+                paper_features(papers[i : i + FEATURE_CHUNK_SIZE], self.hash_dim)
+                @ self.weights
+                + self.bias
+                for i in range(0, len(papers), FEATURE_CHUNK_SIZE)
+            ]
+        )
+
+    def save(self, path: str) -> None:
+        ensure_parent_dir(path)
+        # numpy appends .npz to names without it, so write through a file object
+        with atomic_write(path, "wb") as f:
+            np.savez(f, weights=self.weights, bias=self.bias, hash_dim=self.hash_dim)
+
+    @classmethod
+    def load(cls, path: str) -> "LocalScorer":
+        with np.load(path) as data:
+            return cls(data["weights"], data["bias"], int(data["hash_dim"]))
+
+
+def load_training_data(
+    store_path: str, dump_paths: List[str]
+) -> Tuple[List[Paper], np.ndarray]:
+    # papers with their GPT RELEVANCE and NOVELTY, later sources win for papers scored twice
+    examples = {}
+    if store_path and os.path.exists(store_path):
+        store = PaperStore(store_path)
+        for paper, relevance, novelty in store.scored():
+            examples[paper.arxiv_id] = (paper, relevance, novelty)
+        store.close()
+    fields = [field.name for field in dataclasses.fields(Paper)]
+    for path in dump_paths:
+        with open(path, "r") as f:
+            batches = json.load(f)
+        for batch in batches:
+            for entry in batch:
+                try:
+                    paper = Paper(**{field: entry[field] for field in fields})
+                    examples[paper.arxiv_id] = (
+                        paper,
+                        float(entry["RELEVANCE"]),
+                        float(entry["NOVELTY"]),
+                    )
+                except (KeyError, TypeError, ValueError):
+                    continue
+    # sorted so that the held-out split does not depend on the order of the sources
+    ordered = [examples[arxiv_id] for arxiv_id in sorted(examples)]
+    papers = [paper for paper, _, _ in ordered]
+    scores = np.array(
+        [[relevance, novelty] for _, relevance, novelty in ordered], dtype=np.float32
+    ).reshape(-1, 2)
+    return papers, scores
+
+
+def split_indices(count: int, eval_fraction: float, seed: int = 0):
+    # fixed random train / held-out split of count examples
+    order = np.random.default_rng(seed).permutation(count)
+    eval_count = int(round(count * eval_fraction))
+    return order[eval_count:], order[:eval_count]
+
+
+def local_decisions(predictions: np.ndarray, config) -> np.ndarray:
+    # -1 drops a paper, 1 selects it locally and 0 leaves it to GPT
+    drop_below = config["LOCAL_SCORER"].getfloat("drop_below", fallback=2.5)
+    select_above = config["LOCAL_SCORER"].getfloat("select_above", fallback=8.5)
+    decisions = np.zeros(len(predictions), dtype=np.int8)
+    decisions[predictions[:, 0] < drop_below] = -1
+    decisions[predictions[:, 0] >= select_above] = 1
+    return decisions
+
+
+def agreement_report(predictions: np.ndarray, scores: np.ndarray, config) -> dict:
+    # how well the local scores and decisions agree with GPT
+    selected = (scores[:, 0] >= int(config["FILTERING"]["relevance_cutoff"])) & (
+        scores[:, 1] >= int(config["FILTERING"]["novelty_cutoff"])
+    )
+    decisions = local_decisions(predictions, config)
+    confident = decisions != 0
+    report = {"papers": int(len(scores))}
+    for column, name in enumerate(["relevance", "novelty"]):
+        report[name + "_mae"] = float(
+            np.abs(predictions[:, column] - scores[:, column]).mean()
+        )
+        if len(scores) > 1 and scores[:, column].std() > 0:
+            report[name + "_correlation"] = float(
+                np.corrcoef(predictions[:, column], scores[:, column])[0, 1]
+            )
+    report["sent_to_gpt"] = float((~confident).mean())
+    if confident.any():
+        report["confident_agreement"] = float(
+            ((decisions[confident] == 1) == selected[confident]).mean()
+        )
+        report["wrongly_dropped"] = int(((decisions == -1) & selected).sum())
+        report["wrongly_selected"] = int(((decisions == 1) & ~selected).sum())
+    return report
+
+
+def route_papers(scorer: LocalScorer, papers: List[Paper], config):
+    # splits papers into the uncertain ones for GPT, the locally selected ones with their
+    # predicted scores, and the dropped ones
+    predictions = scorer.predict(papers)
+    decisions = local_decisions(predictions, config)
+    uncertain = []
+    selected = []
+    dropped = []
+    for paper, prediction, decision in zip(papers, predictions.tolist(), decisions):
+        if decision == 0:
+            uncertain.append(paper)
+        elif decision == 1:
+            selected.append((paper, prediction[0], prediction[1]))
+        else:
+            dropped.append(paper)
+    return uncertain, selected, dropped
+
+
+def load_local_scorer(config):
+    # the trained scorer, or None when it is disabled or was never trained
+    if not config["LOCAL_SCORER"].getboolean("enabled", fallback=False):
+        return None
+    model_path = config["LOCAL_SCORER"]["model_path"]
+    try:
+        return LocalScorer.load(model_path)
+    except OSError:
+        print(
+            "Warning: no local scorer at "
+            + model_path
+            + " - run python local_scorer.py train, sending every paper to GPT"
+        )
+        return None
+
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read("configs/config.ini")
+    parser = argparse.ArgumentParser(
+        description="Train or evaluate the local scorer on historical GPT scores"
+    )
+    parser.add_argument("command", choices=["train", "eval"])
+    parser.add_argument(
+        "--dumps",
+        nargs="*",
+        default=[],
+        help="gpt_paper_batches.debug.json files to learn from besides the paper store",
+    )
+    parser.add_argument(
+        "--eval-fraction",
+        type=float,
+        default=0.2,
+        help="share of the papers held out to measure agreement with GPT",
+    )
+    args = parser.parse_args()
+    papers, scores = load_training_data(
+        config["CACHE"].get("paper_store_path", fallback=""), args.dumps
+    )
+    if len(papers) < 2:
+        raise SystemExit("not enough GPT scored papers to train on")
+    train, held_out = split_indices(len(papers), args.eval_fraction)
+    model_path = config["LOCAL_SCORER"]["model_path"]
+    if args.command == "train":
+        scorer = LocalScorer.fit(
+            [papers[i] for i in train],
+            scores[train],
+            config["LOCAL_SCORER"].getint("hash_dim", fallback=4096),
+            config["LOCAL_SCORER"].getfloat("ridge_alpha", fallback=1.0),
+        )
+        scorer.save(model_path)
+        print("Trained on " + str(len(train)) + " papers, saved to " + model_path)
+    else:
+        scorer = LocalScorer.load(model_path)
+    if len(held_out) > 0:
+        predictions = scorer.predict([papers[i] for i in held_out])
+        print(
+            json.dumps(
+                agreement_report(predictions, scores[held_out], config), indent=4
+            )
+        )
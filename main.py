@@ -1,24 +1,56 @@
+import argparse
+import atexit
 import json
 import configparser
+import dataclasses
 import os
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from openai import OpenAI
 from requests import Session
+from requests.adapters import HTTPAdapter
 from typing import TypeVar, Generator
 import io
 
-from retry import retry
 from tqdm import tqdm
 
-from arxiv_scraper import get_papers_from_arxiv_rss_api
-from filter_papers import filter_by_author, filter_by_gpt
+from author_cache import AuthorCache
+from author_index import AuthorNameIndex, normalize_name_key
+from arxiv_scraper import (
+    Paper,
+    get_papers_from_arxiv_rss_api,
+    get_papers_from_arxiv_concurrent,
+)
+from filter_papers import (
+    author_hindex_table,
+    filter_by_author,
+    filter_by_gpt,
+    filter_papers_by_hindex,
+    filter_papers_by_title,
+    make_completion_cache,
+    make_request_slots,
+    make_score_selector,
+    make_token_bucket,
+    paper_max_hindex,
+    prefilter_papers,
+    run_on_batch,
+    scoring_batches,
+)
+from local_scorer import load_local_scorer, route_papers
+from metrics import METRICS
+from paper_store import PaperStore, restore_selected_papers
 from parse_json_to_md import render_md_string
 from push_to_slack import push_to_slack
 from push_to_lark import push_to_lark
+from rate_limit import TokenBucket
+from run_checkpoints import STAGES, RunCheckpoints
 from arxiv_scraper import EnhancedJSONEncoder
 
 T = TypeVar("T")
+# the S2 paper batch endpoint takes at most 500 ids per request
+S2_PAPER_BATCH_SIZE = 500
 
 
 def batched(items: list[T], batch_size: int) -> list[T]:
@@ -55,14 +87,15 @@ def get_paper_batch(
     }
 
     # https://api.semanticscholar.org/api-docs/graph#tag/Paper-Data/operation/post_graph_get_papers
-    with session.post(
-        "https://api.semanticscholar.org/graph/v1/paper/batch",
-        params=params,
-        headers=headers,
-        json=body,
-    ) as response:
-        response.raise_for_status()
-        return response.json()
+    with METRICS.call("s2"):
+        with session.post(
+            "https://api.semanticscholar.org/graph/v1/paper/batch",
+            params=params,
+            headers=headers,
+            json=body,
+        ) as response:
+            response.raise_for_status()
+            return response.json()
 
 
 def get_author_batch(
@@ -87,17 +120,17 @@ def get_author_batch(
         "ids": ids,
     }
 
-    with session.post(
-        "https://api.semanticscholar.org/graph/v1/author/batch",
-        params=params,
-        headers=headers,
-        json=body,
-    ) as response:
-        response.raise_for_status()
-        return response.json()
+    with METRICS.call("s2"):
+        with session.post(
+            "https://api.semanticscholar.org/graph/v1/author/batch",
+            params=params,
+            headers=headers,
+            json=body,
+        ) as response:
+            response.raise_for_status()
+            return response.json()
 
 
-@retry(tries=3, delay=2.0)
 def get_one_author(session, author: str, S2_API_KEY: str) -> str:
     # query the right endpoint https://api.semanticscholar.org/graph/v1/author/search?query=adam+smith
     params = {"query": author, "fields": "authorId,name,hIndex", "limit": "10"}
@@ -107,22 +140,19 @@ def get_one_author(session, author: str, S2_API_KEY: str) -> str:
         headers = {
             "X-API-KEY": S2_API_KEY,
         }
-    with session.get(
-        "https://api.semanticscholar.org/graph/v1/author/search",
-        params=params,
-        headers=headers,
-    ) as response:
-        # try catch for errors
-        try:
+    with METRICS.call("s2"):
+        with session.get(
+            "https://api.semanticscholar.org/graph/v1/author/search",
+            params=params,
+            headers=headers,
+        ) as response:
+            # errors are raised so that resolve_author can back off and failed lookups are not cached
             response.raise_for_status()
             response_json = response.json()
             if len(response_json["data"]) >= 1:
                 return response_json["data"]
             else:
                 return None
-        except Exception as ex:
-            print("exception happened" + str(ex))
-            return None
 
 
 def get_papers(
@@ -136,31 +166,284 @@ def get_papers(
             yield from get_paper_batch(session, ids_batch, S2_API_KEY, **kwargs)
 
 
+def call_rate_limited(bucket: TokenBucket, fn, *args, max_tries: int = 5, **kwargs):
+    # calls an S2 endpoint with requests paced by the shared token bucket.
+    # a 429 slows down every worker through the bucket, other errors back off exponentially
+    for attempt in range(max_tries):
+        bucket.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as ex:
+            response = getattr(ex, "response", None)
+            if response is not None and response.status_code == 429:
+                retry_after = response.headers.get("Retry-After", "")
+                bucket.throttle(
+                    float(retry_after) if retry_after.isdigit() else 2.0**attempt
+                )
+                METRICS.count("rate_limited", "s2")
+            elif attempt == max_tries - 1:
+                raise
+            else:
+                time.sleep(2.0**attempt)
+            METRICS.count("retries", "s2")
+            continue
+        bucket.recover()
+        return result
+    raise RuntimeError("still rate limited after " + str(max_tries) + " tries")
+
+
+def make_s2_bucket(S2_API_KEY: str, requests_per_second: float = None):
+    if requests_per_second is None:
+        # semantic scholar aggressively rate limits requests without a key
+        requests_per_second = 10.0 if S2_API_KEY is not None else 1.0
+    return TokenBucket(requests_per_second)
+
+
+def s2_rate_limit(config, S2_API_KEY: str):
+    # the configured S2 requests per second, None for the default of make_s2_bucket
+    return config["S2"].getfloat(
+        "rate_limit_with_key" if S2_API_KEY is not None else "rate_limit_without_key",
+        fallback=None,
+    )
+
+
 def get_authors(
-    all_authors: list[str], S2_API_KEY: str, batch_size: int = 100, **kwargs
+    all_authors: list[str],
+    S2_API_KEY: str,
+    batch_size: int = 100,
+    author_cache: AuthorCache = None,
+    max_workers: int = 8,
+    requests_per_second: float = None,
+    bucket: TokenBucket = None,
+    name_index: AuthorNameIndex = None,
+    **kwargs,
 ):
     # first get the list of all author ids by querying by author names
     author_metadata_dict = {}
+    if author_cache is not None:
+        # only names that miss the cache go to the network
+        cached = author_cache.get_many(all_authors)
+        for author, auth_map in cached.items():
+            if auth_map is not None:
+                author_metadata_dict[author] = auth_map
+        all_authors = [author for author in all_authors if author not in cached]
+        print(
+            str(len(cached))
+            + " authors found in cache, looking up "
+            + str(len(all_authors))
+        )
+    variants = {}
+    if name_index is not None:
+        # collapse name variants: reuse metadata of a known variant and look up only one name per
+        # person, preferring the longest spelling since it makes the best search query
+        lookups = []
+        for author in sorted(all_authors, key=len, reverse=True):
+            key = name_index.match(author)
+            if key is None:
+                name_index.add(author, None)
+                variants[normalize_name_key(author)] = [author]
+                lookups.append(author)
+            elif name_index.values[key] is not None:
+                author_metadata_dict[author] = name_index.values[key]
+            elif key in variants:
+                # another spelling of this person is already being looked up
+                variants[key].append(author)
+            # otherwise an earlier call, e.g. for an earlier pipeline chunk, found no match for
+            # this person, so the variant is not looked up again. failed lookups leave no entry
+            # behind, so those are retried
+        print(
+            str(len(all_authors) - len(lookups))
+            + " authors matched name variants, looking up "
+            + str(len(lookups))
+        )
+        all_authors = lookups
+    if bucket is None:
+        bucket = make_s2_bucket(S2_API_KEY, requests_per_second)
+    fetched = {}
     with Session() as session:
-        for author in tqdm(all_authors):
-            auth_map = get_one_author(session, author, S2_API_KEY)
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    call_rate_limited,
+                    bucket,
+                    get_one_author,
+                    session,
+                    author,
+                    S2_API_KEY,
+                ): author
+                for author in all_authors
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                author = futures[future]
+                try:
+                    auth_map = future.result()
+                except Exception as ex:
+                    print("exception happened" + str(ex))
+                    # drop the placeholder so a later call looks this person up again instead
+                    # of treating the failed lookup as a missing author
+                    if name_index is not None:
+                        name_index.remove(author)
+                    continue
+                for variant in variants.get(normalize_name_key(author), [author]):
+                    if auth_map is not None:
+                        author_metadata_dict[variant] = auth_map
+                    fetched[variant] = auth_map
+                if name_index is not None:
+                    name_index.add(author, auth_map)
+                # write to the cache as we go so an interrupted run keeps its lookups
+                if author_cache is not None and len(fetched) >= batch_size:
+                    author_cache.put_many(fetched)
+                    fetched = {}
+    if author_cache is not None:
+        author_cache.put_many(fetched)
+    return author_metadata_dict
+
+
+def match_paper_authors(paper_authors: list[str], s2_authors: list[dict]) -> dict:
+    # maps arxiv author strings to S2 author entries. the lists are in the same order when they
+    # have the same length, otherwise fall back to exact name matches.
+    if len(paper_authors) == len(s2_authors):
+        return dict(zip(paper_authors, s2_authors))
+    by_name = {normalize_name_key(entry["name"]): entry for entry in s2_authors}
+    matched = {}
+    for author in paper_authors:
+        if normalize_name_key(author) in by_name:
+            matched[author] = by_name[normalize_name_key(author)]
+    return matched
+
+
+def get_authors_by_paper(
+    papers: list[Paper],
+    S2_API_KEY: str,
+    author_cache: AuthorCache = None,
+    max_workers: int = 8,
+    requests_per_second: float = None,
+    paper_batch_size: int = S2_PAPER_BATCH_SIZE,
+    author_batch_size: int = 1000,
+    name_index: AuthorNameIndex = None,
+    bucket: TokenBucket = None,
+):
+    # resolves authors through the S2 paper batch endpoint, which returns exact author ids
+    # for every paper S2 already knows, then fetches their h-index with the author batch endpoint.
+    # papers S2 has not indexed yet, or whose batch failed, fall back to the per-name search.
+    if bucket is None:
+        bucket = make_s2_bucket(S2_API_KEY, requests_per_second)
+    author_metadata_dict = {}
+    cached = {}
+    if author_cache is not None:
+        # papers whose authors are all cached are not sent to S2 at all
+        cached = author_cache.get_many(
+            sorted(set([author for paper in papers for author in paper.authors]))
+        )
+        for author, auth_map in cached.items():
             if auth_map is not None:
                 author_metadata_dict[author] = auth_map
-            # add a 20ms wait time to avoid rate limiting
-            # otherwise, semantic scholar aggressively rate limits, so do 1s
-            if S2_API_KEY is not None:
-                time.sleep(0.02)
-            else:
-                time.sleep(1.0)
+        papers = [
+            paper
+            for paper in papers
+            if not all(author in cached for author in paper.authors)
+        ]
+        print(str(len(cached)) + " authors found in cache")
+    author_ids = {}
+    unresolved = set()
+    with Session() as session:
+        for paper_batch in tqdm(batched(papers, paper_batch_size)):
+            try:
+                results = call_rate_limited(
+                    bucket,
+                    get_paper_batch,
+                    session,
+                    ["ARXIV:" + paper.arxiv_id for paper in paper_batch],
+                    S2_API_KEY,
+                    fields="authors",
+                )
+            except Exception as ex:
+                print("paper batch failed, searching its authors by name: " + str(ex))
+                for paper in paper_batch:
+                    unresolved.update(paper.authors)
+                continue
+            for paper, result in zip(paper_batch, results):
+                if result is None:
+                    unresolved.update(paper.authors)
+                    continue
+                s2_authors = [
+                    entry for entry in result["authors"] if entry.get("authorId")
+                ]
+                matched = match_paper_authors(paper.authors, s2_authors)
+                for author in paper.authors:
+                    if author in cached:
+                        continue
+                    if author in matched:
+                        author_ids.setdefault(author, set()).add(
+                            matched[author]["authorId"]
+                        )
+                    else:
+                        unresolved.add(author)
+
+        all_ids = sorted(set().union(*author_ids.values())) if author_ids else []
+        author_entries = {}
+        for id_batch in batched(all_ids, author_batch_size):
+            # authors of a failed batch get no entries and go to the name search below
+            try:
+                results = call_rate_limited(
+                    bucket,
+                    get_author_batch,
+                    session,
+                    id_batch,
+                    S2_API_KEY,
+                    fields="authorId,name,hIndex,citationCount",
+                )
+            except Exception as ex:
+                print("author batch failed: " + str(ex))
+                continue
+            for entry in results:
+                if entry is not None:
+                    author_entries[entry["authorId"]] = entry
+
+    resolved = {}
+    for author, ids in author_ids.items():
+        entries = [author_entries[id] for id in sorted(ids) if id in author_entries]
+        if entries:
+            resolved[author] = entries
+        else:
+            unresolved.add(author)
+    if author_cache is not None:
+        author_cache.put_many(resolved)
+    author_metadata_dict.update(resolved)
+    unresolved = unresolved - author_metadata_dict.keys() - cached.keys()
+    print(
+        str(len(resolved))
+        + " authors resolved through paper batches, "
+        + str(len(unresolved))
+        + " left for name search"
+    )
+    author_metadata_dict.update(
+        get_authors(
+            list(unresolved),
+            S2_API_KEY,
+            author_cache=author_cache,
+            max_workers=max_workers,
+            bucket=bucket,
+            name_index=name_index,
+        )
+    )
     return author_metadata_dict
 
 
 def get_papers_from_arxiv(config):
-    area_list = config["FILTERING"]["arxiv_category"].split(",")
+    area_list = [
+        area.strip() for area in config["FILTERING"]["arxiv_category"].split(",")
+    ]
     paper_set = set()
-    for area in area_list:
-        papers = get_papers_from_arxiv_rss_api(area.strip(), config)
-        paper_set.update(set(papers))
+    if config["FETCHING"].getboolean("concurrent_fetch", fallback=False):
+        for papers in get_papers_from_arxiv_concurrent(area_list, config):
+            paper_set.update(set(papers))
+    else:
+        for area in area_list:
+            papers = get_papers_from_arxiv_rss_api(area, config)
+            paper_set.update(set(papers))
     if config["OUTPUT"].getboolean("debug_messages"):
         print("Number of papers:" + str(len(paper_set)))
     return paper_set
@@ -181,10 +464,626 @@ def parse_authors(lines):
     return authors, author_ids
 
 
+def profile_file_path(path: str, name: str) -> str:
+    # out/papers.sqlite -> out/papers_alice.sqlite
+    root, ext = os.path.splitext(path)
+    return root + "_" + name + ext
+
+
+def load_profiles(config) -> list[dict]:
+    # every profile has its own topics, tracked authors and outputs. without [PROFILES] there is
+    # a single unnamed profile made of configs/paper_topics.txt and configs/authors.txt
+    names = []
+    if config.has_section("PROFILES"):
+        names = [
+            name.strip()
+            for name in config["PROFILES"].get("profiles", fallback="").split(",")
+            if name.strip()
+        ]
+    if not names:
+        with open("configs/paper_topics.txt", "r") as f:
+            criterion = f.read()
+        with io.open("configs/authors.txt", "r") as fopen:
+            author_names, author_ids = parse_authors(fopen.readlines())
+        return [
+            {
+                "name": "",
+                "config": config,
+                "criterion": criterion,
+                "author_names": author_names,
+                "author_ids": author_ids,
+                "files": ["configs/paper_topics.txt", "configs/authors.txt"],
+            }
+        ]
+    profile_root = config["PROFILES"].get("profile_path", fallback="configs/profiles/")
+    profiles = []
+    for name in names:
+        profile_dir = os.path.join(profile_root, name)
+        # the profile's config.ini only holds the settings that differ from configs/config.ini
+        overrides = configparser.ConfigParser()
+        overrides.read(os.path.join(profile_dir, "config.ini"))
+        profile_config = configparser.ConfigParser()
+        profile_config.read(
+            ["configs/config.ini", os.path.join(profile_dir, "config.ini")]
+        )
+        # per-profile state that is not set explicitly gets a path of its own
+        for section, key in [
+            ("CACHE", "paper_store_path"),
+            ("LOCAL_SCORER", "model_path"),
+            ("SELECTION", "batch_state_path"),
+        ]:
+            if (
+                profile_config.has_option(section, key)
+                and profile_config[section][key]
+                and not overrides.has_option(section, key)
+            ):
+                profile_config[section][key] = profile_file_path(
+                    profile_config[section][key], name
+                )
+        if not overrides.has_option("OUTPUT", "output_path"):
+            profile_config["OUTPUT"]["output_path"] = (
+                os.path.join(profile_config["OUTPUT"]["output_path"], name) + "/"
+            )
+        os.makedirs(profile_config["OUTPUT"]["output_path"], exist_ok=True)
+        with open(os.path.join(profile_dir, "paper_topics.txt"), "r") as f:
+            criterion = f.read()
+        with io.open(os.path.join(profile_dir, "authors.txt"), "r") as fopen:
+            author_names, author_ids = parse_authors(fopen.readlines())
+        profiles.append(
+            {
+                "name": name,
+                "config": profile_config,
+                "criterion": criterion,
+                "author_names": author_names,
+                "author_ids": author_ids,
+                "files": [
+                    os.path.join(profile_dir, file_name)
+                    for file_name in ["config.ini", "paper_topics.txt", "authors.txt"]
+                ],
+            }
+        )
+    return profiles
+
+
+def select_candidates(profile: dict, papers: list[Paper]) -> None:
+    # picks the papers of the shared fetch the profile still has to decide on, stored in profile
+    config = profile["config"]
+    # look up papers processed by earlier runs before any network or LLM work
+    profile["paper_store"] = None
+    profile["stored_papers"] = {}
+    if config["CACHE"].get("paper_store_path", fallback=""):
+        profile["paper_store"] = PaperStore(config["CACHE"]["paper_store_path"])
+        profile["stored_papers"] = profile["paper_store"].lookup(
+            [paper.arxiv_id for paper in papers]
+        )
+        papers = [
+            paper for paper in papers if paper.arxiv_id not in profile["stored_papers"]
+        ]
+        METRICS.count("cache_hits", "paper_store", len(profile["stored_papers"]))
+        METRICS.count("cache_misses", "paper_store", len(papers))
+        if config["OUTPUT"].getboolean("debug_messages"):
+            print(
+                "Reusing stored results for "
+                + str(len(profile["stored_papers"]))
+                + " already processed papers"
+            )
+    profile["papers"] = papers
+    # cheap local prefilter so that author enrichment only runs on candidate papers
+    candidate_papers = papers
+    prefilter = config["FILTERING"].get("prefilter", fallback="none")
+    if prefilter != "none":
+        candidate_papers = prefilter_papers(papers, profile["criterion"], config)
+        if config["OUTPUT"].getboolean("debug_messages"):
+            print(
+                str(len(candidate_papers))
+                + " of "
+                + str(len(papers))
+                + " papers after "
+                + prefilter
+                + " prefiltering"
+            )
+    profile["candidate_papers"] = candidate_papers
+    profile["locally_selected"] = []
+
+
+def open_author_lookup(config):
+    # the author cache and the fuzzy name index, either can be None when disabled
+    author_cache = None
+    if config["CACHE"].get("author_cache_path", fallback=""):
+        author_cache = AuthorCache(
+            config["CACHE"]["author_cache_path"],
+            config["CACHE"].getfloat("author_cache_ttl_days", fallback=30),
+            config["CACHE"].getint("author_cache_max_entries", fallback=200000),
+        )
+    name_index = None
+    if config["S2"].getboolean("fuzzy_name_matching", fallback=False):
+        name_index = AuthorNameIndex(
+            config["S2"].getfloat("fuzzy_name_threshold", fallback=0.95)
+        )
+        if author_cache is not None:
+            for name, metadata in author_cache.items():
+                name_index.add(name, metadata)
+    return author_cache, name_index
+
+
+def resolve_authors(
+    candidate_papers: list[Paper],
+    config,
+    S2_API_KEY: str,
+    author_cache=None,
+    name_index=None,
+    known_authors=(),
+    bucket: TokenBucket = None,
+) -> dict:
+    # looks up the authors of the candidates that are not in known_authors yet. callers that
+    # resolve in several calls pass one bucket, so the S2 rate limit and its backoff carry over
+    all_authors = set()
+    for paper in candidate_papers:
+        all_authors.update(set(paper.authors))
+    all_authors.difference_update(known_authors)
+    if config["OUTPUT"].getboolean("debug_messages"):
+        print("Getting author info for " + str(len(all_authors)) + " authors")
+    requests_per_second = s2_rate_limit(config, S2_API_KEY)
+    if config["S2"].get("author_resolution", fallback="search") == "paper_batch":
+        return get_authors_by_paper(
+            [
+                paper
+                for paper in candidate_papers
+                if not all(author in known_authors for author in paper.authors)
+            ],
+            S2_API_KEY,
+            author_cache=author_cache,
+            max_workers=config["S2"].getint("max_workers", fallback=8),
+            requests_per_second=requests_per_second,
+            name_index=name_index,
+            bucket=bucket,
+        )
+    return get_authors(
+        list(all_authors),
+        S2_API_KEY,
+        author_cache=author_cache,
+        max_workers=config["S2"].getint("max_workers", fallback=8),
+        requests_per_second=requests_per_second,
+        bucket=bucket,
+        name_index=name_index,
+    )
+
+
+def lookup_authors(candidate_papers: list[Paper], config, S2_API_KEY: str) -> dict:
+    # one author pass for the candidates of every profile
+    author_cache, name_index = open_author_lookup(config)
+    all_authors = resolve_authors(
+        candidate_papers, config, S2_API_KEY, author_cache, name_index
+    )
+    if author_cache is not None:
+        author_cache.close()
+    return all_authors
+
+
+def make_tracked_index(profile: dict) -> AuthorNameIndex:
+    # tracked authors are matched by their exact normalized name on every paper, including the
+    # ones that were prefiltered and never get their authors looked up
+    tracked_index = AuthorNameIndex()
+    for name, author_id in zip(profile["author_names"], profile["author_ids"]):
+        tracked_index.add(name, author_id)
+    return tracked_index
+
+
+def make_local_router(profile: dict):
+    # the route callback of filter_by_gpt: the local scorer decides the papers it is confident
+    # about and GPT only scores the rest. it sees the papers that passed the h-index and title
+    # filters, the same population the GPT scores it was trained on come from. None without a
+    # local scorer
+    config = profile["config"]
+    local_scorer = load_local_scorer(config)
+    if local_scorer is None:
+        return None
+
+    def route(papers: list[Paper]) -> list[Paper]:
+        uncertain, selected, dropped = route_papers(local_scorer, papers, config)
+        profile["locally_selected"] += selected
+        if config["OUTPUT"].getboolean("debug_messages"):
+            print(
+                "Local scorer selected "
+                + str(len(selected))
+                + ", dropped "
+                + str(len(dropped))
+                + " and left "
+                + str(len(uncertain))
+                + " papers to GPT"
+            )
+        return uncertain
+
+    return route
+
+
+def score_profile(
+    profile: dict, all_authors: dict, hindex_table: dict, openai_client
+) -> dict:
+    # runs author matching and GPT scoring for one profile and returns its ranked selection
+    config = profile["config"]
+    selected_papers, all_papers, sort_dict = filter_by_author(
+        all_authors,
+        profile["papers"],
+        set(profile["author_ids"]),
+        config,
+        make_tracked_index(profile),
+    )
+    scored_papers = filter_by_gpt(
+        all_authors,
+        profile["candidate_papers"],
+        config,
+        openai_client,
+        all_papers,
+        selected_papers,
+        sort_dict,
+        hindex_table,
+        profile["criterion"],
+        make_local_router(profile),
+    )
+    return finish_profile(
+        profile, selected_papers, sort_dict, scored_papers, hindex_table
+    )
+
+
+def finish_profile(
+    profile: dict,
+    selected_papers: dict,
+    sort_dict: dict,
+    scored_papers: dict,
+    hindex_table: dict,
+) -> dict:
+    # merges local and stored results into the scores, records them and ranks the selection
+    config = profile["config"]
+    papers = profile["papers"]
+    # papers dropped by the prefilter are decided as well
+    candidate_ids = set([paper.arxiv_id for paper in profile["candidate_papers"]])
+    for paper in papers:
+        if paper.arxiv_id not in candidate_ids:
+            scored_papers[paper.arxiv_id] = None
+    for paper, relevance, novelty in profile["locally_selected"]:
+        # local estimates are not stored as GPT scores, so they never end up in training data
+        scored_papers.pop(paper.arxiv_id, None)
+        if paper.arxiv_id not in selected_papers:
+            selected_papers[paper.arxiv_id] = {
+                **dataclasses.asdict(paper),
+                "ARXIVID": paper.arxiv_id,
+                "COMMENT": "Local scorer estimate",
+                "RELEVANCE": round(relevance, 1),
+                "NOVELTY": round(novelty, 1),
+            }
+            sort_dict[paper.arxiv_id] = relevance + novelty
+    paper_store = profile["paper_store"]
+    if paper_store is not None:
+        # only remember outcomes of complete runs, otherwise papers would never get scored
+        if config["SELECTION"].getboolean("run_openai"):
+            paper_store.record(papers, selected_papers, scored_papers)
+        restore_selected_papers(
+            profile["stored_papers"], selected_papers, sort_dict, config
+        )
+        paper_store.close()
+
+    # sort the papers by relevance and novelty, ties go to the paper with the strongest author
+    # and then to the newer arxiv id. scores arrive in any order, so sort_dict's order must not
+    # decide ties
+    keys = list(sort_dict.keys())
+    max_hindex = paper_max_hindex(
+        [selected_papers[key]["authors"] for key in keys], hindex_table
+    )
+    values = list(zip(sort_dict.values(), max_hindex.tolist(), keys))
+    for key, paper_hindex in zip(keys, max_hindex.tolist()):
+        # only shown for papers whose authors were looked up today
+        if any(author in hindex_table for author in selected_papers[key]["authors"]):
+            selected_papers[key]["MAX_HINDEX"] = paper_hindex
+    sorted_keys = [keys[idx] for idx in argsort(values)[::-1]]
+    selected_papers = {key: selected_papers[key] for key in sorted_keys}
+    if config["OUTPUT"].getboolean("debug_messages"):
+        print(sort_dict)
+        print(selected_papers)
+    return selected_papers
+
+
+def enrich_candidates(
+    profiles: list[dict],
+    candidate_papers: list[Paper],
+    config,
+    S2_API_KEY: str,
+    outboxes: list[queue.Queue],
+    all_authors: dict,
+    lookup: bool = True,
+    bucket: TokenBucket = None,
+) -> None:
+    # first stage of the streaming pipeline: looks up the authors of the candidates chunk by
+    # chunk and hands every chunk on to the profiles it is a candidate of. with lookup False,
+    # all_authors already holds the checkpointed authors
+    chunk_size = max(1, config["SELECTION"].getint("pipeline_chunk_size", fallback=50))
+    # the paper batch endpoint is looked up in full batches, which are then handed on in chunks
+    lookup_size = chunk_size
+    if config["S2"].get("author_resolution", fallback="search") == "paper_batch":
+        lookup_size = max(chunk_size, S2_PAPER_BATCH_SIZE)
+    author_cache, name_index = open_author_lookup(config) if lookup else (None, None)
+    profile_candidates = [
+        set([paper.arxiv_id for paper in profile["candidate_papers"]])
+        for profile in profiles
+    ]
+    try:
+        for lookup_batch in batched(candidate_papers, lookup_size):
+            if lookup:
+                all_authors.update(
+                    resolve_authors(
+                        lookup_batch,
+                        config,
+                        S2_API_KEY,
+                        author_cache,
+                        name_index,
+                        all_authors,
+                        bucket,
+                    )
+                )
+            for chunk in batched(lookup_batch, chunk_size):
+                for outbox, candidate_ids in zip(outboxes, profile_candidates):
+                    profile_chunk = [
+                        paper for paper in chunk if paper.arxiv_id in candidate_ids
+                    ]
+                    if profile_chunk:
+                        outbox.put(profile_chunk)
+    finally:
+        if author_cache is not None:
+            author_cache.close()
+        for outbox in outboxes:
+            outbox.put(None)
+
+
+def stream_score_profile(
+    profile: dict,
+    inbox: queue.Queue,
+    all_authors: dict,
+    openai_client,
+    token_bucket: TokenBucket = None,
+    request_slots=None,
+) -> dict:
+    # consumer of the streaming pipeline: title filters every chunk of candidates as soon as its
+    # authors are known and starts scoring as soon as a batch is full, so GPT calls overlap with
+    # the author lookups of later chunks. the token bucket and request slots are shared by the
+    # consumers of all profiles. returns the ranked selection like score_profile
+    config = profile["config"]
+    max_workers = config["SELECTION"].getint("max_concurrent_requests", fallback=1)
+    all_cost = 0
+    scoring = []
+    pending = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        try:
+            criterion = profile["criterion"]
+            with open("configs/base_prompt.txt", "r") as f:
+                base_prompt = f.read()
+            with open("configs/postfix_prompt.txt", "r") as f:
+                postfix_prompt = f.read()
+            all_papers = {paper.arxiv_id: paper for paper in profile["papers"]}
+            selected_papers = {}
+            sort_dict = {}
+            scored_papers = {}
+            select_scored_paper = make_score_selector(
+                config, all_papers, selected_papers, sort_dict, scored_papers
+            )
+            run_openai = config["SELECTION"].getboolean("run_openai")
+            completion_cache = make_completion_cache(config) if run_openai else None
+            route = make_local_router(profile) if run_openai else None
+            while True:
+                candidate_papers = inbox.get()
+                if candidate_papers is None:
+                    break
+                if not run_openai:
+                    continue
+                # the author dict is still growing, so each chunk gets its own h-index table
+                chunk_authors = {
+                    author: all_authors[author]
+                    for paper in candidate_papers
+                    for author in paper.authors
+                    if author in all_authors
+                }
+                paper_list = filter_papers_by_hindex(
+                    chunk_authors, candidate_papers, config
+                )
+                paper_list, cost = filter_papers_by_title(
+                    paper_list,
+                    config,
+                    openai_client,
+                    base_prompt,
+                    criterion,
+                    token_bucket,
+                    completion_cache,
+                    request_slots,
+                )
+                all_cost += cost
+                if route is not None:
+                    paper_list = route(paper_list)
+                kept_ids = set([paper.arxiv_id for paper in paper_list])
+                for paper in candidate_papers:
+                    if paper.arxiv_id not in kept_ids:
+                        scored_papers[paper.arxiv_id] = None
+                # full batches go out right away, the last one waits for more papers
+                batches = scoring_batches(
+                    pending + paper_list, config, base_prompt, criterion, postfix_prompt
+                )
+                for batch in batches[:-1]:
+                    scoring.append(
+                        executor.submit(
+                            run_on_batch,
+                            batch,
+                            base_prompt,
+                            criterion,
+                            postfix_prompt,
+                            openai_client,
+                            config,
+                            token_bucket,
+                            completion_cache,
+                            select_scored_paper,
+                            request_slots,
+                        )
+                    )
+                pending = batches[-1] if batches else []
+        except BaseException:
+            # keeps the author stage from blocking on the full queue of a scorer that failed,
+            # during its setup or on a chunk
+            while inbox.get() is not None:
+                pass
+            raise
+        if pending:
+            scoring.append(
+                executor.submit(
+                    run_on_batch,
+                    pending,
+                    base_prompt,
+                    criterion,
+                    postfix_prompt,
+                    openai_client,
+                    config,
+                    token_bucket,
+                    completion_cache,
+                    select_scored_paper,
+                    request_slots,
+                )
+            )
+        scored_batches = []
+        for future in scoring:
+            json_dicts, cost = future.result()
+            all_cost += cost
+            scored_batches.append(
+                [
+                    {**dataclasses.asdict(all_papers[jdict["ARXIVID"]]), **jdict}
+                    for jdict in json_dicts
+                ]
+            )
+    if run_openai:
+        if config["OUTPUT"].getboolean("dump_debug_file"):
+            with open(
+                config["OUTPUT"]["output_path"] + "gpt_paper_batches.debug.json", "w"
+            ) as outfile:
+                json.dump(scored_batches, outfile, cls=EnhancedJSONEncoder, indent=4)
+        if completion_cache is not None:
+            completion_cache.close()
+        if config["OUTPUT"].getboolean("debug_messages"):
+            print(str(len(scoring)) + " scoring batches, total cost: $" + str(all_cost))
+    # every author is known by now. author matches only count where GPT did not select the
+    # paper, the same precedence as filter_by_author followed by filter_by_gpt
+    author_selected, _, author_sort = filter_by_author(
+        all_authors,
+        profile["papers"],
+        set(profile["author_ids"]),
+        config,
+        make_tracked_index(profile),
+    )
+    for arxiv_id, paper_dict in author_selected.items():
+        if arxiv_id not in selected_papers:
+            selected_papers[arxiv_id] = paper_dict
+            sort_dict[arxiv_id] = author_sort[arxiv_id]
+    return finish_profile(
+        profile,
+        selected_papers,
+        sort_dict,
+        scored_papers,
+        author_hindex_table(all_authors),
+    )
+
+
+def run_pipeline(
+    profiles: list[dict],
+    candidate_papers: list[Paper],
+    config,
+    openai_client,
+    S2_API_KEY: str,
+    all_authors: dict = None,
+):
+    # streaming variant of the author and scoring stages. the author lookup and one scorer per
+    # profile run in their own threads connected by bounded queues, so a chunk of candidates is
+    # title filtered and scored while the authors of the next chunks are still being looked up,
+    # and memory stays flat. the S2 and OpenAI limits are created once here and shared by every
+    # chunk and profile. returns the authors and the ranked selection of every profile
+    queue_size = max(1, config["SELECTION"].getint("pipeline_queue_size", fallback=4))
+    profile_queues = [queue.Queue(maxsize=queue_size) for _ in profiles]
+    lookup = all_authors is None
+    if lookup:
+        all_authors = {}
+    s2_bucket = make_s2_bucket(S2_API_KEY, s2_rate_limit(config, S2_API_KEY))
+    token_bucket = make_token_bucket(config)
+    request_slots = make_request_slots(config)
+    with ThreadPoolExecutor(max_workers=1 + len(profiles)) as stages:
+        consumers = [
+            stages.submit(
+                stream_score_profile,
+                profile,
+                profile_queue,
+                all_authors,
+                openai_client,
+                token_bucket,
+                request_slots,
+            )
+            for profile, profile_queue in zip(profiles, profile_queues)
+        ]
+        try:
+            enrich_candidates(
+                profiles,
+                candidate_papers,
+                config,
+                S2_API_KEY,
+                profile_queues,
+                all_authors,
+                lookup,
+                s2_bucket,
+            )
+        finally:
+            selections = [consumer.result() for consumer in consumers]
+    return all_authors, selections
+
+
+def publish(profile: dict, selected_papers: dict) -> None:
+    # writes the profile's outputs and pushes its summaries to its endpoints
+    config = profile["config"]
+    if config["OUTPUT"].getboolean("dump_json"):
+        with open(config["OUTPUT"]["output_path"] + "output.json", "w") as outfile:
+            json.dump(selected_papers, outfile, indent=4)
+    if config["OUTPUT"].getboolean("dump_md"):
+        with open(config["OUTPUT"]["output_path"] + "output.md", "w") as f:
+            f.write(render_md_string(selected_papers, profile["criterion"]))
+    # only push to slack for non-empty dicts
+    if config["OUTPUT"].getboolean("push_to_slack"):
+        SLACK_KEY = os.environ.get("SLACK_KEY")
+        if SLACK_KEY is None:
+            print(
+                "Warning: push_to_slack is true, but SLACK_KEY is not set - not pushing to slack"
+            )
+        else:
+            push_to_slack(
+                selected_papers,
+                config["OUTPUT"].get("slack_channel_id", fallback=None),
+            )
+    push_to_lark(
+        selected_papers, config["OUTPUT"].get("lark_webhook_url", fallback=None)
+    )
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Daily arxiv paper selection")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the stages that already finished today with the same configuration",
+    )
+    parser.add_argument(
+        "--from-stage",
+        choices=STAGES,
+        help="reuse the checkpoints before this stage and run everything from it on",
+    )
+    args = parser.parse_args()
     # now load config.ini
     config = configparser.ConfigParser()
     config.read("configs/config.ini")
+    # written on exit, so a run that fails halfway still leaves its numbers behind
+    atexit.register(
+        METRICS.write,
+        config["OUTPUT"].get("metrics_path", fallback=""),
+        config["OUTPUT"].get("prometheus_path", fallback=""),
+    )
 
     S2_API_KEY = os.environ.get("S2_KEY")
     OAI_KEY = os.environ.get("OAI_KEY")
@@ -195,20 +1094,82 @@ if __name__ == "__main__":
             "OpenAI key is not set - please set OAI_KEY to your OpenAI key"
         )
     openai_client = OpenAI(api_key=OAI_KEY, base_url=BASE_URL)
-    # load the author list
-    with io.open("configs/authors.txt", "r") as fopen:
-        author_names, author_ids = parse_authors(fopen.readlines())
-    author_id_set = set(author_ids)
-
-    papers = list(get_papers_from_arxiv(config))
-    # dump all papers for debugging
+    profiles = load_profiles(config)
+    config_files = [
+        "configs/config.ini",
+        "configs/base_prompt.txt",
+        "configs/postfix_prompt.txt",
+    ]
+    for profile in profiles:
+        config_files += profile["files"]
+    checkpoints = RunCheckpoints(
+        config["OUTPUT"].get("run_path", fallback="out/runs/"),
+        config_files,
+        args.resume,
+        args.from_stage,
+    )
 
-    all_authors = set()
-    for paper in papers:
-        all_authors.update(set(paper.authors))
-    if config["OUTPUT"].getboolean("debug_messages"):
-        print("Getting author info for " + str(len(all_authors)) + " authors")
-    all_authors = get_authors(list(all_authors), S2_API_KEY)
+    # the fetch and the author pass are shared, only scoring runs once per profile
+    fetched = checkpoints.load("fetch")
+    if fetched is None:
+        with METRICS.stage("fetch"):
+            papers = list(get_papers_from_arxiv(config))
+        earlier = checkpoints.read("fetch")
+        if not papers and earlier:
+            # a rerun of the day whose feeds came back empty keeps the papers fetched earlier
+            print(
+                "No papers fetched, reusing the "
+                + str(len(earlier))
+                + " fetched earlier"
+            )
+            papers = [Paper(**paper) for paper in earlier]
+        else:
+            checkpoints.save("fetch", [dataclasses.asdict(paper) for paper in papers])
+    else:
+        print("Resuming with " + str(len(fetched)) + " fetched papers")
+        papers = [Paper(**paper) for paper in fetched]
+    all_authors = checkpoints.load("authors")
+    selections = {}
+    for profile in profiles:
+        selections[profile["name"]] = checkpoints.load("scoring", profile["name"])
+    pending_profiles = [
+        profile for profile in profiles if selections[profile["name"]] is None
+    ]
+    candidate_papers = {}
+    for profile in pending_profiles:
+        with METRICS.stage("prefilter", profile["name"]):
+            select_candidates(profile, papers)
+        for paper in profile["candidate_papers"]:
+            candidate_papers[paper.arxiv_id] = paper
+    streaming = config["SELECTION"].get("pipeline", fallback="staged") == "streaming"
+    if streaming and config["SELECTION"].getboolean("batch_mode", fallback=False):
+        # a batch job needs every prompt of the day up front
+        print("Warning: batch_mode needs the staged pipeline, not streaming")
+        streaming = False
+    if streaming and pending_profiles:
+        # lookups and scoring overlap, so they are timed as one stage
+        with METRICS.stage("authors_and_scoring"):
+            streamed_authors, streamed_selections = run_pipeline(
+                pending_profiles,
+                list(candidate_papers.values()),
+                config,
+                openai_client,
+                S2_API_KEY,
+                all_authors,
+            )
+        if all_authors is None:
+            all_authors = streamed_authors
+            checkpoints.save("authors", all_authors)
+        for profile, selected_papers in zip(pending_profiles, streamed_selections):
+            selections[profile["name"]] = selected_papers
+            checkpoints.save("scoring", selected_papers, profile["name"])
+    elif all_authors is None:
+        with METRICS.stage("authors"):
+            all_authors = lookup_authors(
+                list(candidate_papers.values()), config, S2_API_KEY
+            )
+        checkpoints.save("authors", all_authors)
+    fetched_count = len(papers)
 
     if config["OUTPUT"].getboolean("dump_debug_file"):
         with open(
@@ -219,48 +1180,29 @@ if __name__ == "__main__":
             config["OUTPUT"]["output_path"] + "all_authors.debug.json", "w"
         ) as outfile:
             json.dump(all_authors, outfile, cls=EnhancedJSONEncoder, indent=4)
+        author_id_set = set()
+        for profile in profiles:
+            author_id_set.update(profile["author_ids"])
         with open(
             config["OUTPUT"]["output_path"] + "author_id_set.debug.json", "w"
         ) as outfile:
             json.dump(list(author_id_set), outfile, cls=EnhancedJSONEncoder, indent=4)
 
-    selected_papers, all_papers, sort_dict = filter_by_author(
-        all_authors, papers, author_id_set, config
-    )
-    filter_by_gpt(
-        all_authors,
-        papers,
-        config,
-        openai_client,
-        all_papers,
-        selected_papers,
-        sort_dict,
-    )
-
-    # sort the papers by relevance and novelty
-    keys = list(sort_dict.keys())
-    values = list(sort_dict.values())
-    sorted_keys = [keys[idx] for idx in argsort(values)[::-1]]
-    selected_papers = {key: selected_papers[key] for key in sorted_keys}
-    if config["OUTPUT"].getboolean("debug_messages"):
-        print(sort_dict)
-        print(selected_papers)
-
-    # pick endpoints and push the summaries
-    if len(papers) > 0:
-        if config["OUTPUT"].getboolean("dump_json"):
-            with open(config["OUTPUT"]["output_path"] + "output.json", "w") as outfile:
-                json.dump(selected_papers, outfile, indent=4)
-        if config["OUTPUT"].getboolean("dump_md"):
-            with open(config["OUTPUT"]["output_path"] + "output.md", "w") as f:
-                f.write(render_md_string(selected_papers))
-        # only push to slack for non-empty dicts
-        if config["OUTPUT"].getboolean("push_to_slack"):
-            SLACK_KEY = os.environ.get("SLACK_KEY")
-            if SLACK_KEY is None:
-                print(
-                    "Warning: push_to_slack is true, but SLACK_KEY is not set - not pushing to slack"
+    if pending_profiles and not streaming:
+        # author strength is compiled once and shared by the h-index filter and the ranking
+        hindex_table = author_hindex_table(all_authors)
+        for profile in pending_profiles:
+            if profile["name"]:
+                print("Scoring profile " + profile["name"])
+            with METRICS.stage("scoring", profile["name"]):
+                selected_papers = score_profile(
+                    profile, all_authors, hindex_table, openai_client
                 )
-            else:
-                push_to_slack(selected_papers)
-        push_to_lark(selected_papers)
+            selections[profile["name"]] = selected_papers
+            checkpoints.save("scoring", selected_papers, profile["name"])
+    for profile in profiles:
+        # pick endpoints and push the summaries
+        if fetched_count > 0 and checkpoints.load("publish", profile["name"]) is None:
+            with METRICS.stage("publish", profile["name"]):
+                publish(profile, selections[profile["name"]])
+            checkpoints.save("publish", True, profile["name"])
@@ -0,0 +1,278 @@
+"""
+Lightweight instrumentation shared by every module of a run.
+Records the wall time of each stage, call counts, errors and latency percentiles per upstream
+(arxiv, s2, openai, lark, slack), retries, cache hits and misses, and tokens and cost per model.
+main.py writes the numbers at the end of a run as a JSON summary and as a Prometheus text file,
+which the node_exporter textfile collector can pick up to follow latency and spend day to day.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from storage import atomic_write, ensure_parent_dir
+
+# latency percentiles reported per upstream
+PERCENTILES = [50, 90, 99]
+# prefix of every Prometheus metric name
+PROMETHEUS_PREFIX = "paper_assistant_"
+
+
+def prometheus_labels(labels: dict) -> str:
+    # {stage="fetch",profile=""} with quotes, backslashes and newlines escaped
+    escaped = [
+        key
+        + '="'
+        + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for key, value in labels.items()
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+class RunMetrics:
+    def __init__(self) -> None:
+        # metrics are recorded from the fetch, lookup and scoring threads at once
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started_at = time.time()
+            # (stage, profile) -> seconds
+            self.stages = {}
+            # upstream -> latencies in seconds of every call, failed ones included
+            self.latencies = {}
+            # upstream -> number of calls that raised
+            self.errors = {}
+            # (event, label) -> count, e.g. ("retries", "s2") or ("cache_hits", "completion")
+            self.counters = {}
+            # model -> requests, prompt tokens, completion tokens and cost in dollars
+            self.usage = {}
+
+    @contextmanager
+    def stage(self, name: str, profile: str = ""):
+        # adds the wall time of the block to the stage
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                key = (name, profile)
+                self.stages[key] = self.stages.get(key, 0.0) + elapsed
+
+    @contextmanager
+    def call(self, upstream: str):
+        # times one call to an upstream, a call that raises counts as an error
+        started = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.latencies.setdefault(upstream, []).append(elapsed)
+                if failed:
+                    self.errors[upstream] = self.errors.get(upstream, 0) + 1
+
+    def count(self, event: str, label: str = "", value: int = 1) -> None:
+        with self.lock:
+            key = (event, label)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record_usage(
+        self, model: str, prompt_tokens: int, completion_tokens: int, cost: float
+    ) -> None:
+        with self.lock:
+            usage = self.usage.setdefault(
+                model,
+                {
+                    "requests": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "cost": 0.0,
+                },
+            )
+            usage["requests"] += 1
+            usage["prompt_tokens"] += prompt_tokens or 0
+            usage["completion_tokens"] += completion_tokens or 0
+            usage["cost"] += cost or 0.0
+
+    def summary(self) -> dict:
+        with self.lock:
+            upstreams = {}
+            for upstream, latencies in sorted(self.latencies.items()):
+                values = np.percentile(latencies, PERCENTILES).tolist()
+                upstreams[upstream] = {
+                    "calls": len(latencies),
+                    "errors": self.errors.get(upstream, 0),
+                    "latency_seconds_total": float(sum(latencies)),
+                    **{
+                        "latency_p" + str(percentile): value
+                        for percentile, value in zip(PERCENTILES, values)
+                    },
+                }
+            counters = {}
+            for (event, label), value in sorted(self.counters.items()):
+                counters.setdefault(event, {})[label] = value
+            return {
+                "started_at": self.started_at,
+                "wall_seconds": time.time() - self.started_at,
+                "stages": [
+                    {"stage": name, "profile": profile, "seconds": seconds}
+                    for (name, profile), seconds in self.stages.items()
+                ],
+                "upstreams": upstreams,
+                "counters": counters,
+                "usage": {model: dict(usage) for model, usage in self.usage.items()},
+                "total_cost": sum(usage["cost"] for usage in self.usage.values()),
+            }
+
+    def prometheus(self) -> str:
+        # the summary in the Prometheus text exposition format
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP " + PROMETHEUS_PREFIX + name + " " + help_text)
+            lines.append("# TYPE " + PROMETHEUS_PREFIX + name + " " + kind)
+            for suffix, labels, value in samples:
+                lines.append(
+                    PROMETHEUS_PREFIX
+                    + name
+                    + suffix
+                    + (prometheus_labels(labels) if labels else "")
+                    + " "
+                    + repr(float(value))
+                )
+
+        metric(
+            "run_start_timestamp_seconds",
+            "gauge",
+            "Unix time the run started.",
+            [("", {}, summary["started_at"])],
+        )
+        metric(
+            "run_duration_seconds",
+            "gauge",
+            "Wall time of the whole run.",
+            [("", {}, summary["wall_seconds"])],
+        )
+        metric(
+            "stage_duration_seconds",
+            "gauge",
+            "Wall time spent in a stage.",
+            [
+                (
+                    "",
+                    {"stage": stage["stage"], "profile": stage["profile"]},
+                    stage["seconds"],
+                )
+                for stage in summary["stages"]
+            ],
+        )
+        latency_samples = []
+        for upstream, stats in summary["upstreams"].items():
+            for percentile in PERCENTILES:
+                latency_samples.append(
+                    (
+                        "",
+                        {"upstream": upstream, "quantile": str(percentile / 100)},
+                        stats["latency_p" + str(percentile)],
+                    )
+                )
+            latency_samples.append(
+                ("_sum", {"upstream": upstream}, stats["latency_seconds_total"])
+            )
+            latency_samples.append(("_count", {"upstream": upstream}, stats["calls"]))
+        metric(
+            "upstream_latency_seconds",
+            "summary",
+            "Latency of calls to an upstream service.",
+            latency_samples,
+        )
+        metric(
+            "upstream_errors_total",
+            "counter",
+            "Calls to an upstream service that failed.",
+            [
+                ("", {"upstream": upstream}, stats["errors"])
+                for upstream, stats in summary["upstreams"].items()
+            ],
+        )
+        metric(
+            "events_total",
+            "counter",
+            "Retries, cache hits and other counted events.",
+            [
+                ("", {"event": event, "label": label}, value)
+                for event, values in summary["counters"].items()
+                for label, value in values.items()
+            ],
+        )
+        usage_samples = []
+        for model, usage in summary["usage"].items():
+            for kind in ["prompt_tokens", "completion_tokens"]:
+                usage_samples.append(
+                    ("", {"model": model, "kind": kind.split("_")[0]}, usage[kind])
+                )
+        metric(
+            "llm_tokens_total",
+            "counter",
+            "Tokens sent to and received from a model.",
+            usage_samples,
+        )
+        metric(
+            "llm_requests_total",
+            "counter",
+            "Completions used per model, replayed ones included.",
+            [
+                ("", {"model": model}, usage["requests"])
+                for model, usage in summary["usage"].items()
+            ],
+        )
+        metric(
+            "llm_cost_dollars_total",
+            "counter",
+            "Estimated spend per model.",
+            [
+                ("", {"model": model}, usage["cost"])
+                for model, usage in summary["usage"].items()
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path: str = "", prometheus_path: str = "") -> None:
+        # writes the summary to the paths that are set
+        outputs = []
+        if json_path:
+            outputs.append((json_path, json.dumps(self.summary(), indent=4)))
+        if prometheus_path:
+            outputs.append((prometheus_path, self.prometheus()))
+        for path, content in outputs:
+            ensure_parent_dir(path)
+            with atomic_write(path) as f:
+                f.write(content)
+
+
+class RetryCounter:
+    # logger for retry.retry, which calls warning() before every retry: counts the retry for the
+    # upstream and logs it like retry's default logger does
+    def __init__(self, metrics: RunMetrics, upstream: str) -> None:
+        self.metrics = metrics
+        self.upstream = upstream
+        self.logger = logging.getLogger("retry.api")
+
+    def warning(self, message: str, *args) -> None:
+        self.metrics.count("retries", self.upstream)
+        self.logger.warning(message, *args)
+
+
+# the metrics of the current run, shared by every module
+METRICS = RunMetrics()
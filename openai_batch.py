@@ -0,0 +1,223 @@
+"""
+Offline scoring through the OpenAI Batch API, which answers within a day at half the price.
+Prompts are written to a JSONL job file, uploaded and submitted as one batch, and the answers are
+written into the completion cache, so the normal title filter and scoring flow then runs on them
+without live requests. The submitted job is persisted, so a restarted run resumes polling the same
+batch instead of submitting it again.
+The endpoints are called directly with requests against the client's base_url, which also lets a
+local mock of the batch endpoints stand in for OpenAI.
+"""
+
+import hashlib
+import json
+import os
+import time
+from types import SimpleNamespace
+from typing import Dict, Tuple
+
+import requests
+
+from metrics import METRICS
+from storage import atomic_write, ensure_parent_dir
+
+# batch requests are billed at half the price of live requests
+BATCH_PRICE_FACTOR = 0.5
+# batch states after which the batch will not change any more
+FINAL_STATES = ["completed", "failed", "expired", "cancelled"]
+
+
+class BatchClient:
+    def __init__(self, base_url: str, api_key: str, timeout: float = 60.0) -> None:
+        self.base_url = str(base_url).rstrip("/") + "/"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "Bearer " + str(api_key)
+
+    def upload_file(self, path: str) -> str:
+        with open(path, "rb") as f, METRICS.call("openai"):
+            response = self.session.post(
+                self.base_url + "files",
+                files={"file": (os.path.basename(path), f)},
+                data={"purpose": "batch"},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        return response.json()["id"]
+
+    def create_batch(self, input_file_id: str) -> dict:
+        with METRICS.call("openai"):
+            response = self.session.post(
+                self.base_url + "batches",
+                json={
+                    "input_file_id": input_file_id,
+                    "endpoint": "/v1/chat/completions",
+                    "completion_window": "24h",
+                },
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        return response.json()
+
+    def get_batch(self, batch_id: str) -> dict:
+        with METRICS.call("openai"):
+            response = self.session.get(
+                self.base_url + "batches/" + batch_id, timeout=self.timeout
+            )
+            response.raise_for_status()
+        return response.json()
+
+    def file_content(self, file_id: str) -> str:
+        with METRICS.call("openai"):
+            response = self.session.get(
+                self.base_url + "files/" + file_id + "/content", timeout=self.timeout
+            )
+            response.raise_for_status()
+        return response.text
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class BatchJobState:
+    # the submitted job of every phase, keyed by the hash of its job file
+    def __init__(self, state_path: str) -> None:
+        self.state_path = state_path
+        ensure_parent_dir(state_path)
+
+    def load(self) -> dict:
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, phase: str) -> dict:
+        return self.load().get(phase, {})
+
+    def save(self, phase: str, job: dict) -> None:
+        state = self.load()
+        state[phase] = job
+        with atomic_write(self.state_path) as f:
+            json.dump(state, f, indent=4)
+
+
+def batch_request_line(
+    custom_id: str, model: str, prompt: str, temperature: float = 0.0, seed: int = 0
+) -> str:
+    # one line of the job file, the same request call_chatgpt sends
+    return json.dumps(
+        {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": temperature,
+                "seed": seed,
+            },
+        }
+    )
+
+
+def parse_batch_output(text: str) -> Dict[str, SimpleNamespace]:
+    # maps custom_id to a completion for every request that succeeded. failed requests are left
+    # out, the normal flow sends them again as live requests
+    completions = {}
+    for line in text.split("\n"):
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            continue
+        body = response["body"]
+        usage = body.get("usage") or {}
+        completions[result["custom_id"]] = SimpleNamespace(
+            choices=[
+                SimpleNamespace(
+                    message=SimpleNamespace(
+                        content=body["choices"][0]["message"]["content"]
+                    )
+                )
+            ],
+            usage=SimpleNamespace(
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+            ),
+        )
+    return completions
+
+
+def run_batch_job(
+    phase: str,
+    prompts: Dict[str, Tuple[str, float, int]],
+    model: str,
+    client: BatchClient,
+    state: BatchJobState,
+    config,
+) -> Dict[str, SimpleNamespace]:
+    # submits the (prompt, temperature, seed) requests, keyed by custom_id, as one batch, waits
+    # for it and returns the completions by custom_id. a job for the same requests that was
+    # submitted before is resumed
+    if not prompts:
+        return {}
+    job_path = config["SELECTION"].get("batch_path", fallback="out/batch/")
+    poll_interval = config["SELECTION"].getfloat("batch_poll_interval", fallback=60)
+    max_wait = config["SELECTION"].getfloat("batch_max_wait_hours", fallback=24) * 3600
+    lines = [
+        batch_request_line(custom_id, model, prompt, temperature, seed)
+        for custom_id, (prompt, temperature, seed) in sorted(prompts.items())
+    ]
+    content = "\n".join(lines) + "\n"
+    input_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    job = state.get(phase)
+    if job.get("input_hash") == input_hash and job.get("status") not in [
+        "failed",
+        "expired",
+        "cancelled",
+    ]:
+        print("Resuming " + phase + " batch " + job["batch_id"])
+    else:
+        os.makedirs(job_path, exist_ok=True)
+        path = os.path.join(job_path, phase + "_" + input_hash[:12] + ".jsonl")
+        with open(path, "w") as f:
+            f.write(content)
+        batch = client.create_batch(client.upload_file(path))
+        job = {
+            "batch_id": batch["id"],
+            "input_hash": input_hash,
+            "status": batch["status"],
+            "requests": len(lines),
+        }
+        state.save(phase, job)
+        print("Submitted " + phase + " batch " + job["batch_id"])
+    started = time.monotonic()
+    while True:
+        batch = client.get_batch(job["batch_id"])
+        if batch["status"] != job["status"]:
+            job["status"] = batch["status"]
+            state.save(phase, job)
+        if batch["status"] in FINAL_STATES:
+            break
+        if time.monotonic() - started > max_wait:
+            raise TimeoutError(
+                phase
+                + " batch "
+                + job["batch_id"]
+                + " is still "
+                + batch["status"]
+                + ", rerun to resume polling"
+            )
+        time.sleep(poll_interval)
+    if batch["status"] != "completed" or not batch.get("output_file_id"):
+        print(
+            phase
+            + " batch "
+            + job["batch_id"]
+            + " ended as "
+            + batch["status"]
+            + ", falling back to live requests"
+        )
+        return {}
+    return parse_batch_output(client.file_content(batch["output_file_id"]))
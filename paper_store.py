@@ -0,0 +1,123 @@
+"""
+Persistent store of papers that already went through the pipeline, keyed by arxiv id.
+Every processed paper is recorded with the date it was processed and its scores, so reruns and
+feeds that repeat entries reuse the stored results instead of paying for author lookups and GPT calls again.
+"""
+
+import dataclasses
+import json
+import sqlite3
+from datetime import date
+
+from arxiv_scraper import Paper
+from storage import LOOKUP_CHUNK_SIZE, ensure_parent_dir
+
+
+class PaperStore:
+    def __init__(self, db_path: str) -> None:
+        ensure_parent_dir(db_path)
+        # the streaming pipeline looks papers up and records them from different threads,
+        # never at the same time
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS papers (
+                arxiv_id TEXT PRIMARY KEY,
+                processed_date TEXT NOT NULL,
+                paper TEXT NOT NULL,
+                author_match INTEGER NOT NULL,
+                relevance NUMERIC,
+                novelty NUMERIC,
+                comment TEXT
+            )
+            """
+        )
+        self.connection.commit()
+
+    def lookup(self, arxiv_ids: list[str]) -> dict[str, dict]:
+        # returns the stored record for every id that was processed before
+        stored = {}
+        for i in range(0, len(arxiv_ids), LOOKUP_CHUNK_SIZE):
+            chunk = arxiv_ids[i : i + LOOKUP_CHUNK_SIZE]
+            rows = self.connection.execute(
+                "SELECT arxiv_id, processed_date, paper, author_match, relevance, novelty, comment "
+                "FROM papers WHERE arxiv_id IN (" + ",".join("?" * len(chunk)) + ")",
+                chunk,
+            )
+            for row in rows:
+                stored[row[0]] = {
+                    "processed_date": row[1],
+                    "paper": Paper(**json.loads(row[2])),
+                    "author_match": bool(row[3]),
+                    "RELEVANCE": row[4],
+                    "NOVELTY": row[5],
+                    "COMMENT": row[6],
+                }
+        return stored
+
+    def record(
+        self, papers: list[Paper], selected_papers: dict, scored_papers: dict
+    ) -> None:
+        # stores every paper whose outcome is known: author matches, papers dropped before scoring
+        # (None in scored_papers) and scored papers. papers GPT never answered for are left out so
+        # the next run scores them.
+        today = date.today().isoformat()
+        rows = []
+        for paper in papers:
+            author_match = (
+                selected_papers.get(paper.arxiv_id, {}).get("COMMENT") == "Author match"
+            )
+            if paper.arxiv_id not in scored_papers and not author_match:
+                continue
+            scores = scored_papers.get(paper.arxiv_id) or {}
+            rows.append(
+                (
+                    paper.arxiv_id,
+                    today,
+                    json.dumps(dataclasses.asdict(paper)),
+                    int(author_match),
+                    scores.get("RELEVANCE"),
+                    scores.get("NOVELTY"),
+                    scores.get("COMMENT"),
+                )
+            )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self.connection.commit()
+
+    def scored(self) -> list[tuple[Paper, float, float]]:
+        # every stored paper with its GPT relevance and novelty scores
+        rows = self.connection.execute(
+            "SELECT paper, relevance, novelty FROM papers "
+            "WHERE relevance IS NOT NULL AND novelty IS NOT NULL"
+        )
+        return [
+            (Paper(**json.loads(paper)), float(relevance), float(novelty))
+            for paper, relevance, novelty in rows.fetchall()
+        ]
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def restore_selected_papers(stored: dict, selected_papers, sort_dict, config):
+    # replays the selection logic of filter_by_author and filter_by_gpt on stored results
+    for arxiv_id, record in stored.items():
+        paper_dict = dataclasses.asdict(record["paper"])
+        if (
+            record["RELEVANCE"] is not None
+            and record["RELEVANCE"] >= int(config["FILTERING"]["relevance_cutoff"])
+            and record["NOVELTY"] >= int(config["FILTERING"]["novelty_cutoff"])
+        ):
+            selected_papers[arxiv_id] = {
+                **paper_dict,
+                "ARXIVID": arxiv_id,
+                "COMMENT": record["COMMENT"],
+                "RELEVANCE": record["RELEVANCE"],
+                "NOVELTY": record["NOVELTY"],
+            }
+            sort_dict[arxiv_id] = record["RELEVANCE"] + record["NOVELTY"]
+        elif record["author_match"]:
+            selected_papers[arxiv_id] = {**paper_dict, "COMMENT": "Author match"}
+            sort_dict[arxiv_id] = float(config["SELECTION"]["author_match_score"])
@@ -31,6 +31,9 @@ def render_paper(paper_entry: dict, idx: int) -> str:
         novelty = paper_entry["NOVELTY"]
         paper_string += f"**Relevance:** {relevance}\n\n"
         paper_string += f"**Novelty:** {novelty}\n\n"
+    if "MAX_HINDEX" in paper_entry:
+        max_hindex = int(paper_entry["MAX_HINDEX"])
+        paper_string += f"**Highest author h-index:** {max_hindex}\n\n"
     return paper_string + "\n---\n"
 
 
@@ -42,10 +45,11 @@ def render_title_and_author(paper_entry: dict, idx: int) -> str:
     return paper_string
 
 
-def render_md_string(papers_dict):
+def render_md_string(papers_dict, criterion=None):
     # header
-    with open("configs/paper_topics.txt", "r") as f:
-        criterion = f.read()
+    if criterion is None:
+        with open("configs/paper_topics.txt", "r") as f:
+            criterion = f.read()
     output_string = (
         "# Personalized Daily Arxiv Papers "
         + datetime.today().strftime("%m/%d/%Y")
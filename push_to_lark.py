@@ -10,6 +10,9 @@ import os
 import asyncio
 
 from openai import OpenAI
+
+from filter_papers import track_cost
+from metrics import METRICS
 from push_to_lark_table import LarkTableManager, TokenManager
 
 url = (
@@ -47,17 +50,21 @@ def get_abstract(abstract):
         api_key=OAI_KEY,
         base_url=BASE_URL,
     )
-    chat_completion = client.chat.completions.create(
-        messages=messages,
-        model="gpt-4o-2024-05-13",
-    )
+    with METRICS.call("openai"):
+        chat_completion = client.chat.completions.create(
+            messages=messages,
+            model="gpt-4o-2024-05-13",
+        )
+    track_cost("gpt-4o-2024-05-13", chat_completion.usage)
 
     return chat_completion.choices[0].message.content
 
 
 class LarkBot:
-    def __init__(self, secret=None) -> None:
+    def __init__(self, secret=None, webhook_url=None) -> None:
         self.secret = secret
+        # profiles can post to their own bot, everyone else uses the default webhook
+        self.webhook_url = webhook_url or url
 
     def send(self, body) -> None:
         # body = self.format_paper_context(body)
@@ -75,7 +82,8 @@ class LarkBot:
             }
         body = json.dumps({"msg_type": "interactive", "card": json.dumps(content, ensure_ascii=False)})
         headers = {"Content-Type": "application/json"}
-        res = requests.post(url=url, data=body, headers=headers)
+        with METRICS.call("lark"):
+            res = requests.post(url=self.webhook_url, data=body, headers=headers)
         print(res)
 
     def format_paper_context(self, papers_dict):
@@ -168,8 +176,8 @@ def render_title(paper_entry, counter: int) -> str:
     return [title, arxiv_url, abstract, authors]
 
 
-def push_to_lark(papers_dict):
-    lark_bot = LarkBot()
+def push_to_lark(papers_dict, webhook_url=None):
+    lark_bot = LarkBot(webhook_url=webhook_url)
     lark_bot.send(papers_dict)
 
 
@@ -10,6 +10,7 @@ from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
 from arxiv_scraper import Paper
+from metrics import METRICS
 
 T = TypeVar("T")
 
@@ -22,13 +23,14 @@ def batched(items: list[T], batch_size: int) -> list[T]:
 def send_main_message(block_list: List, channel_id, client):
     try:
         # Call the conversations.list method using the WebClient
-        result = client.chat_postMessage(
-            channel=channel_id,
-            blocks=block_list,
-            text="Arxiv update",
-            unfurl_links=False,
-            # You could also use a blocks[] array to send richer content
-        )
+        with METRICS.call("slack"):
+            result = client.chat_postMessage(
+                channel=channel_id,
+                blocks=block_list,
+                text="Arxiv update",
+                unfurl_links=False,
+                # You could also use a blocks[] array to send richer content
+            )
         # Print result, which includes information about the message (like TS)
         print(result)
         return result["ts"]
@@ -42,14 +44,15 @@ def send_thread(block_list: List, channel_id, thread_id, client):
         batches = batched(block_list, 50)
         # Call the conversations.list method using the WebClient
         for batch in batches:
-            result = client.chat_postMessage(
-                thread_ts=thread_id,
-                text="Arxiv full update",
-                channel=channel_id,
-                blocks=batch,
-                unfurl_links=False,
-                # You could also use a blocks[] array to send richer content
-            )
+            with METRICS.call("slack"):
+                result = client.chat_postMessage(
+                    thread_ts=thread_id,
+                    text="Arxiv full update",
+                    channel=channel_id,
+                    blocks=batch,
+                    unfurl_links=False,
+                    # You could also use a blocks[] array to send richer content
+                )
             # Print result, which includes information about the message (like TS)
             print(result)
 
@@ -166,8 +169,10 @@ def build_block_list(title_strings, paper_strings):
     return slack_block_list, thread_blocks
 
 
-def push_to_slack(papers_dict):
-    channel_id = os.environ["SLACK_CHANNEL_ID"]
+def push_to_slack(papers_dict, channel_id=None):
+    # channel_id defaults to the SLACK_CHANNEL_ID environment variable
+    if channel_id is None:
+        channel_id = os.environ["SLACK_CHANNEL_ID"]
     client = WebClient(token=os.environ["SLACK_KEY"])
     # render each paper
     if len(papers_dict) == 0:
@@ -0,0 +1,63 @@
+"""
+Thread-safe token bucket used to pace requests against rate limited services.
+Workers call acquire() before each request. When the service answers with a 429, throttle() pauses
+every worker for the requested time and halves the refill rate; the rate then recovers step by step
+with every successful request, so we settle just below what the service actually allows.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = None):
+        # rate is in tokens per second, capacity is the largest burst allowed
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        # blocks until the requested tokens are available. requests larger than the capacity
+        # are let through once the bucket is full, so they cannot block forever.
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return
+                    wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, delay: float) -> None:
+        # called on a 429: stop everyone for delay seconds and halve the rate
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.paused_until = max(self.paused_until, now + delay)
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self.tokens = 0.0
+            self.updated = max(now, self.paused_until)
+
+    def recover(self) -> None:
+        # called after a successful request: grow the rate back towards its configured maximum
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 32.0)
@@ -0,0 +1,80 @@
+"""
+Stage checkpoints of a main.py run.
+Every stage writes its output to a run directory named after the date and a hash of the
+configuration, so a rerun of the same day with --resume skips the stages that already finished,
+e.g. repeats only the push when a sink failed. --from-stage forces a restart from a given stage.
+Once a stage runs again, every later stage runs again as well, per profile for the profile stages.
+"""
+
+import hashlib
+import json
+import os
+from datetime import date
+from typing import List, Optional
+
+from storage import atomic_write
+
+STAGES = ["fetch", "authors", "scoring", "publish"]
+
+
+def config_hash(paths: List[str]) -> str:
+    # hash of the configuration and prompt files, a changed setting starts a new run directory
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(path.encode("utf-8"))
+        try:
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        except OSError:
+            digest.update(b"missing")
+    return digest.hexdigest()[:12]
+
+
+class RunCheckpoints:
+    def __init__(
+        self,
+        run_path: str,
+        config_files: List[str],
+        resume: bool = False,
+        from_stage: Optional[str] = None,
+    ) -> None:
+        self.run_dir = os.path.join(
+            run_path, date.today().isoformat() + "_" + config_hash(config_files)
+        )
+        os.makedirs(self.run_dir, exist_ok=True)
+        # index of the first stage that has to run, checkpoints from there on are ignored.
+        # profiles can fall behind on their own, so profile stages are tracked per profile too
+        self.rerun_from = len(STAGES) if resume or from_stage else 0
+        if from_stage is not None:
+            self.rerun_from = STAGES.index(from_stage)
+        self.profile_rerun_from = {}
+
+    def _path(self, stage: str, name: str) -> str:
+        return os.path.join(
+            self.run_dir, stage + ("_" + name if name else "") + ".json"
+        )
+
+    def load(self, stage: str, name: str = ""):
+        # returns the checkpointed output of the stage, or None when the stage has to run
+        index = STAGES.index(stage)
+        if index >= min(self.rerun_from, self.profile_rerun_from.get(name, index + 1)):
+            return None
+        data = self.read(stage, name)
+        if data is None:
+            if name:
+                self.profile_rerun_from[name] = index
+            else:
+                self.rerun_from = index
+        return data
+
+    def read(self, stage: str, name: str = ""):
+        # the checkpointed output of the stage even when it runs again, None when there is none
+        try:
+            with open(self._path(stage, name), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, stage: str, data, name: str = "") -> None:
+        with atomic_write(self._path(stage, name)) as f:
+            json.dump(data, f)
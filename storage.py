@@ -0,0 +1,27 @@
+"""
+Helpers shared by the on-disk caches, stores and state files.
+State files are written through atomic_write, so a crashed or interrupted run leaves either the
+old or the new file behind, never a half written one.
+"""
+
+import os
+from contextlib import contextmanager
+
+# sqlite limits the number of bound parameters per statement, so lookups are chunked
+LOOKUP_CHUNK_SIZE = 500
+
+
+def ensure_parent_dir(path: str) -> None:
+    # creates the directory a file is about to be written to, paths without one are left alone
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    # yields a temporary file next to path, which replaces path once the block has finished
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode) as f:
+        yield f
+    os.replace(tmp_path, path)